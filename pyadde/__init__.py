@@ -1,2 +1,2 @@
-from pyadde import client, util
-__all__ = ['client', 'util']
\ No newline at end of file
+from pyadde import client, util, cache, catalog, table, scheduler, failover
+__all__ = ['client', 'util', 'cache', 'catalog', 'table', 'scheduler', 'failover']
\ No newline at end of file
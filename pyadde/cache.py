@@ -0,0 +1,222 @@
+import os
+import mmap
+import time
+import hashlib
+import logging
+import collections
+import functools
+import tempfile
+import asyncio
+
+_, n = os.path.split(os.path.abspath(__file__))
+
+logger = logging.getLogger(n)
+
+ADDE_ALL_POSITION = 1095519264  # ALL in binary int 32, see AddeClient._compose_adir_req_text_
+
+
+def canonical_request(host=None, port=None, req_type=None, req_text=None):
+    """
+    Create the canonical text of an ADDE request. ADDE is not case sensitive and
+    the request text is blank padded so the case and the whitespace are normalized
+    :param host: str, ADDE server
+    :param port: int, ADDE port
+    :param req_type: str, adir, aget, txtg
+    :param req_text: str, request text created by AddeClient._compose_adir_req_text_/_compose_aget_req_text_
+    :return: str
+    """
+    return f'{host.lower()}:{port} {req_type.lower()} {" ".join(req_text.split()).upper()}'
+
+
+def is_relative(req_text=None):
+    """
+    Check if the request addresses the data relative to the most recent dataset position (position<=0, ALL, X)
+    or is a text file request. The response to such a request changes as new data arrives on the server.
+    :param req_text: str, request text
+    :return: bool
+    """
+    tokens = req_text.split()
+    if len(tokens) < 3:
+        return True
+    try:
+        pos = int(tokens[2])
+    except ValueError:
+        return True
+    return pos <= 0 or pos == ADDE_ALL_POSITION
+
+
+class ResponseCache():
+    """
+    Persistent on-disk cache of decompressed ADDE responses.
+    The responses are stored one per file named after the hash of the canonical request. The total size is bounded
+    and the least recently used responses are evicted first. The access time of a file is its LRU timestamp
+    while the modification time is its creation time and is used to expire the responses to relative requests.
+    Small hits are read into bytes, the large ones are memory mapped so they are not read into RAM. A mapping lives
+    as long as the memoryview returned by get and the arrays over it, release() the view (or use it as a context
+    manager) to unmap the file right away.
+    """
+
+    def __init__(self, directory=None, max_size=2**30, relative_ttl=60, mmap_min_size=2**20):
+        """
+        :param directory: str, folder holding the cached responses
+        :param max_size: int, max total size of the cached responses in bytes
+        :param relative_ttl: number, seconds the responses to relative requests (position<=0 or ALL) are valid
+        :param mmap_min_size: int, size of the smallest response that is memory mapped instead of read
+        """
+        assert directory, f'Invalid cache directory {directory}'
+        assert max_size > 0, f'Invalid max_size {max_size}'
+        self.directory = directory
+        self.max_size = max_size
+        self.relative_ttl = relative_ttl
+        self.mmap_min_size = mmap_min_size
+        self.hits = self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index_ = collections.OrderedDict()
+        self._size_ = 0
+        self._load_index_()
+        self._evict_()
+
+    def _load_index_(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.bin'):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.append((st.st_atime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index_[key] = size
+            self._size_ += size
+
+    def _path_(self, key=None):
+        return os.path.join(self.directory, f'{key}.bin')
+
+    @staticmethod
+    def key(host=None, port=None, req_type=None, req_text=None):
+        return hashlib.sha1(canonical_request(host=host, port=port, req_type=req_type, req_text=req_text).encode('ascii')).hexdigest()
+
+    @property
+    def size(self):
+        return self._size_
+
+    def get(self, host=None, port=None, req_type=None, req_text=None):
+        """
+        Lookup a response
+        :return: bytes or a memoryview over the memory mapped response, None if it is not cached or it has expired
+        """
+        key = self.key(host=host, port=port, req_type=req_type, req_text=req_text)
+        path = self._path_(key)
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if is_relative(req_text) and time.time() - st.st_mtime > self.relative_ttl:
+                    self._discard_(key)
+                    self.misses += 1
+                    return
+                if not st.st_size:
+                    raise ValueError(f'Empty cached response {path}')
+                if st.st_size < self.mmap_min_size:
+                    data = f.read()
+                else:
+                    data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            os.utime(path, (time.time(), st.st_mtime))
+        except (FileNotFoundError, ValueError):
+            self._index_.pop(key, None)
+            self.misses += 1
+            return
+        if key in self._index_:
+            self._index_.move_to_end(key)
+        self.hits += 1
+        logger.debug(f'Serving {req_type} req "{req_text}" to {host} from cache')
+        return data
+
+    def put(self, host=None, port=None, req_type=None, req_text=None, data=None):
+        """
+        Store a response. Error responses (the first 4 bytes are 0) are not cached
+        :param data: bytes like, the decompressed response
+        """
+        if data is None or len(data) < 8 or int.from_bytes(data[:4], 'big') == 0:
+            return
+        size = len(data)
+        if size > self.max_size:
+            return
+        key = self.key(host=host, port=port, req_type=req_type, req_text=req_text)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path_(key))
+        except PermissionError as e:  # on Windows a file can not be replaced while it is mapped
+            logger.debug(f'Failed to store {key} in cache {self.directory}: {e}')
+            os.remove(tmp_path)
+            return
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._size_ += size - self._index_.pop(key, 0)
+        self._index_[key] = size
+        self._evict_()
+
+    def _discard_(self, key=None):
+        self._size_ -= self._index_.pop(key, 0)
+        try:
+            os.remove(self._path_(key))
+        except FileNotFoundError:
+            pass
+        except PermissionError as e:  # still mapped on Windows, indexed again when the cache is reopened
+            logger.debug(f'Failed to remove {key} from cache {self.directory}: {e}')
+
+    def _evict_(self):
+        while self._size_ > self.max_size and self._index_:
+            key = next(iter(self._index_))
+            logger.debug(f'Evicting {key} from cache {self.directory}')
+            self._discard_(key)
+
+    def clear(self):
+        for key in list(self._index_):
+            self._discard_(key)
+
+
+class SingleFlight():
+    """
+    Registry of the requests in flight. Identical concurrent requests (same server, credentials and
+    canonical request text) are coalesced, the duplicates await the outstanding request and share its result.
+    """
+
+    def __init__(self):
+        self._calls_ = dict()
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls_)
+
+    async def do(self, key=None, factory=None):
+        """
+        Run factory() unless a call with the same key is in flight, in which case its result is awaited.
+        The shared call is shielded so a cancelled caller does not cancel it for the others.
+        :param key: hashable, identifies the request
+        :param factory: coroutine function without args performing the request
+        :return: the result of factory()
+        """
+        # the futures belong to a loop
+        key = id(asyncio.get_event_loop()), key
+        call = self._calls_.get(key)
+        if call is None:
+            call = asyncio.ensure_future(factory())
+            self._calls_[key] = call
+            call.add_done_callback(functools.partial(self._done_, key))
+        else:
+            self.coalesced += 1
+            logger.debug(f'Coalescing request {key[1]}')
+        return await asyncio.shield(call)
+
+    def _done_(self, key=None, call=None):
+        if self._calls_.get(key) is call:
+            del self._calls_[key]
+        # mark the exception as retrieved in case all callers were cancelled
+        if not call.cancelled():
+            call.exception()
+
+
+# the in flight requests shared by all clients
+INFLIGHT_REQUESTS = SingleFlight()
@@ -0,0 +1,259 @@
+import os
+import time
+import asyncio
+import logging
+import tempfile
+import collections
+
+_, n = os.path.split(os.path.abspath(__file__))
+
+logger = logging.getLogger(n)
+
+
+DescriptorInfo = collections.namedtuple('DescriptorInfo', ['name', 'type', 'format', 'position_range', 'comment'])
+
+
+class ServerCatalog():
+    """
+    Indexed content of the PUBLIC.SRV/RESOLV.SRV file of an ADDE server.
+    The lines parsed by AddeClient._parse_pubsrv_response_ are indexed once into case insensitive
+    dictionaries group->descriptor->DescriptorInfo so the validation of a dataset is a dict lookup.
+    """
+
+    def __init__(self, content=None):
+        """
+        :param content: iterable of dicts, every dict holds the key/values of a catalog line (N1, N2, TYPE, K, R1, R2, C)
+        """
+        # lowercase group name -> (group name, {lowercase descriptor name -> DescriptorInfo})
+        self._groups_ = dict()
+        formats = {True: set(), False: set()}
+        for d in content or ():
+            if not ('N1' in d and 'N2' in d and 'TYPE' in d):
+                continue
+            gname = d['N1']
+            info = DescriptorInfo(
+                name=d['N2'], type=d['TYPE'], format=d.get('K'),
+                position_range=(d.get('R1'), d.get('R2')), comment=d.get('C', '')
+            )
+            group = self._groups_.setdefault(gname.lower(), (gname, dict()))
+            descriptors = group[1]
+            # the image descriptors have priority over the other types with the same name
+            if info.name.lower() not in descriptors or info.type == 'IMAGE':
+                descriptors[info.name.lower()] = info
+            formats[False].add((gname, info.format))
+            if info.type == 'IMAGE':
+                formats[True].add((gname, info.format))
+        self._formats_ = {k: tuple(v) for k, v in formats.items()}
+        self._group_names_ = {k: tuple(sorted({e[0] for e in v})) for k, v in formats.items()}
+
+    def groups(self, only_image=True):
+        """
+        :param only_image: bool, consider only the IMAGE datasets
+        :return: tuple of (group name, format) pairs
+        """
+        return self._formats_[bool(only_image)]
+
+    def group_names(self, only_image=True):
+        return self._group_names_[bool(only_image)]
+
+    def has_group(self, group_name=None, only_image=True):
+        group = self._groups_.get(str(group_name).lower())
+        if group is None:
+            return False
+        return not only_image or any(info.type == 'IMAGE' for info in group[1].values())
+
+    def descriptor(self, group_name=None, descriptor_name=None, only_image=True):
+        """
+        :return: DescriptorInfo or None if the group does not hold the descriptor
+        """
+        group = self._groups_.get(str(group_name).lower())
+        if group is None:
+            return
+        info = group[1].get(str(descriptor_name).lower())
+        if info is None or (only_image and info.type != 'IMAGE'):
+            return
+        return info
+
+    def descriptors(self, group_name=None, only_image=True):
+        """
+        :return: tuple of DescriptorInfo for the group
+        """
+        group = self._groups_.get(str(group_name).lower())
+        if group is None:
+            return ()
+        return tuple(info for info in group[1].values() if not only_image or info.type == 'IMAGE')
+
+    def to_dict(self, only_image=True):
+        """
+        :return: list with one dict per group {name: {format:..., descriptors: {name: comment}}}
+        """
+        glist = []
+        for gname, gformat in self.groups(only_image=only_image):
+            descr = {info.name: info.comment for info in self.descriptors(group_name=gname, only_image=only_image)}
+            glist.append({gname: {'format': gformat, 'descriptors': descr}})
+        return glist
+
+
+
+class CatalogEntry():
+    """
+    The content of the RESOLV.SRV/PUBLIC.SRV file of one ADDE server
+    """
+
+    def __init__(self, binary_content=None, fetched_at=None):
+        self.binary_content = binary_content
+        self.fetched_at = fetched_at or time.time()
+        # parsed and indexed content, filled in by CatalogRegistry._parse_
+        self.content = None
+        self.catalog = None
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+class CatalogRegistry():
+    """
+    Process wide cache of the server catalogs (RESOLV.SRV/PUBLIC.SRV content) shared by all AddeClient instances.
+    A client for a known server gets the catalog without a round trip to the server. Catalogs older than
+    refresh_interval are still served but are refreshed in the background. Optionally the catalogs are persisted
+    in a folder so they survive the process.
+    """
+
+    def __init__(self, directory=None, refresh_interval=3600):
+        """
+        :param directory: str, folder to persist the catalogs in, None to keep them only in memory
+        :param refresh_interval: number, age in seconds after which a catalog is refreshed
+        """
+        self.directory = None
+        self.refresh_interval = refresh_interval
+        self._entries_ = dict()
+        # (id of the event loop, host, port) -> fetch task, the tasks can only be awaited in their own loop
+        self._fetches_ = dict()
+        self.configure(directory=directory)
+
+    def configure(self, directory=None, refresh_interval=None):
+        """
+        Change the persistence folder and/or the refresh interval
+        """
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.directory = directory
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+
+    @staticmethod
+    def key(host=None, port=None):
+        return host.lower(), int(port)
+
+    def _path_(self, key=None):
+        host, port = key
+        return os.path.join(self.directory, f'{host}_{port}.srv')
+
+    def _load_(self, key=None):
+        if self.directory is None:
+            return
+        path = self._path_(key)
+        try:
+            with open(path, 'rb') as f:
+                binary_content = f.read()
+            fetched_at = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return
+        logger.debug(f'Loaded the catalog of {key[0]} from {path}')
+        return CatalogEntry(binary_content=binary_content, fetched_at=fetched_at)
+
+    def _store_(self, key=None, entry=None):
+        if self.directory is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(entry.binary_content)
+            os.replace(tmp_path, self._path_(key))
+        except Exception as e:
+            logger.error(f'Failed to persist the catalog of {key[0]}: {e}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _parse_(entry=None, client=None):
+        """
+        Parse and index the content of an entry. Raises if it is an error response, is truncated or is empty
+        so only valid catalogs are cached and persisted
+        :return: CatalogEntry
+        """
+        entry.content = client._parse_pubsrv_response_(entry.binary_content)
+        if not entry.content:
+            raise Exception(f'The catalog of {client.host} is empty')
+        entry.catalog = ServerCatalog(content=entry.content)
+        return entry
+
+    @staticmethod
+    def _fetch_key_(key=None):
+        return (id(asyncio.get_event_loop()), ) + key
+
+    async def _fetch_(self, key=None, client=None):
+        fetch_key = self._fetch_key_(key)
+        try:
+            binary_content = await client._fetch_binary_content_()
+            if binary_content is None:
+                raise Exception(f'The server {client.host} did not send its catalog')
+            entry = self._parse_(entry=CatalogEntry(binary_content=bytes(binary_content)), client=client)
+            self._entries_[key] = entry
+            self._store_(key=key, entry=entry)
+            return entry
+        finally:
+            del self._fetches_[fetch_key]
+
+    def _schedule_fetch_(self, key=None, client=None):
+        # concurrent fetches of the same catalog in the same event loop are coalesced
+        fetch_key = self._fetch_key_(key)
+        if fetch_key not in self._fetches_:
+            self._fetches_[fetch_key] = asyncio.ensure_future(self._fetch_(key=key, client=client))
+        return self._fetches_[fetch_key]
+
+    async def entry(self, client=None):
+        """
+        Get the catalog of the server the client is connected to
+        :param client: AddeClient instance
+        :return: CatalogEntry
+        """
+        key = self.key(host=client.host, port=client.port)
+        entry = self._entries_.get(key)
+        if entry is None:
+            entry = self._load_(key)
+            if entry is not None:
+                try:
+                    self._entries_[key] = self._parse_(entry=entry, client=client)
+                except Exception as e:
+                    logger.error(f'Discarding the persisted catalog of {client.host}: {e}')
+                    self.invalidate(host=client.host, port=client.port)
+                    entry = None
+        if entry is None:
+            # shield so a cancelled client does not cancel the fetch other clients wait for
+            return await asyncio.shield(self._schedule_fetch_(key=key, client=client))
+
+        if entry.age > self.refresh_interval and self._fetch_key_(key) not in self._fetches_:
+            logger.debug(f'Refreshing the catalog of {client.host} in the background')
+            fetch = self._schedule_fetch_(key=key, client=client)
+            fetch.add_done_callback(self._log_refresh_error_)
+        return entry
+
+    @staticmethod
+    def _log_refresh_error_(fetch):
+        if not fetch.cancelled() and fetch.exception() is not None:
+            logger.error(f'Failed to refresh a catalog: {fetch.exception()}')
+
+    def invalidate(self, host=None, port=None):
+        """
+        Forget the catalog of a server
+        """
+        key = self.key(host=host, port=port)
+        self._entries_.pop(key, None)
+        if self.directory is not None and os.path.exists(self._path_(key)):
+            os.remove(self._path_(key))
+
+
+# the registry shared by all clients
+CATALOG_REGISTRY = CatalogRegistry()
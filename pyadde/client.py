@@ -1,13 +1,24 @@
 import asyncio
 import struct
 from pyadde import util
+from pyadde.catalog import CATALOG_REGISTRY
+from pyadde.table import AreaDirectoryTable, AD_DIRSIZE, AREA_DIRECTORY_WORDS
+from pyadde.cache import INFLIGHT_REQUESTS, canonical_request
+from pyadde.scheduler import CONNECTION_SCHEDULER, PRIORITY_DEFAULT
+from pyadde.failover import HOST_LATENCIES, RETRIABLE_ERRORS, TruncatedResponseError, backoff_delay
 import async_timeout
 import io
 import os
-import gzip
+import zlib
 import datetime
+import collections
 import typing
 import traceback
+import copy
+import collections
+import functools
+import concurrent.futures
+import numpy as np
 from pyarea.directory import area_directory
 from pyarea.file import AreaFile
 import logging
@@ -26,6 +37,343 @@ VALID_COORD_TYPES = 'A', 'I', 'E'
 
 VALID_COORD_POS = 'U', 'C'
 
+VALID_TRANSPORTS = 'stream', 'buffered'
+
+# numpy dtypes of the AREA data by the number of bytes per element
+AREA_DATA_DTYPES = {1: 'u1', 2: '>i2', 4: '>i4'}
+
+# a block of image lines yielded by AddeClient.aget_stream
+# data is an array of shape (bands, lines, elements), prefix holds the line prefix (DOC, calibration, band list) bytes of every line
+AreaLineBlock = collections.namedtuple('AreaLineBlock', ['directory', 'start_line', 'prefix', 'data'])
+
+
+
+class GzipStreamInflater():
+    """
+    Incremental gzip decompressor for ADDE responses.
+    The compressed chunks are fed as they are read from the socket and the inflated bytes are returned right away
+    so the whole compressed response never needs to be held in memory.
+    Concatenated gzip members are handled the same way gzip.GzipFile does.
+    """
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # the first compressed bytes are kept for error reporting
+        self.head = b''
+
+    def inflate(self, data=None):
+        """
+        Decompress a chunk of compressed data
+        :param data: bytes, compressed chunk
+        :return: bytes, the decompressed data available so far
+        """
+        if len(self.head) < 1000:
+            self.head += bytes(data[:1000 - len(self.head)])
+        out = self.decompressor.decompress(data)
+        while self.decompressor.eof:
+            # a new gzip member may start, zero padding between members is ignored like in gzip.GzipFile
+            unused = self.decompressor.unused_data.lstrip(b'\x00')
+            if not unused:
+                break
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += self.decompressor.decompress(unused)
+        return out
+
+    def flush(self):
+        """
+        :return: bytes, whatever is left inside the decompressor
+        """
+        # the connection was closed before the end of the response
+        if not self.head:
+            raise TruncatedResponseError('Empty compressed response')
+        if not self.decompressor.eof:
+            raise TruncatedResponseError('Compressed response ended before the end of stream marker')
+        return self.decompressor.flush()
+
+
+
+class BufferPool():
+    """
+    Pool of the bytearrays the buffered transport receives the responses into.
+    A buffer goes back to the pool as soon as its response is handed over but it is reused only once nothing
+    references its data anymore: a bytearray can not be resized while memoryviews or numpy arrays over it exist.
+    Buffers larger than max_buffer_size are not pooled so the large images are freed as soon as the caller drops
+    them, and the pool keeps at most max_bytes.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, max_buffer_size=16 * 2**20):
+        """
+        :param max_bytes: int, max total size of the pooled buffers
+        :param max_buffer_size: int, size of the largest buffer that is pooled
+        """
+        self.max_bytes = max_bytes
+        self.max_buffer_size = max_buffer_size
+        self._buffers_ = collections.deque()
+        self.size = 0
+        self.allocated = self.reused = 0
+
+    @staticmethod
+    def _in_use_(buffer=None):
+        try:
+            buffer.append(0)
+        except BufferError:
+            return True
+        buffer.pop()
+        return False
+
+    def acquire(self, size=None):
+        """
+        :param size: int, min size of the buffer
+        :return: bytearray of at least size bytes
+        """
+        for buffer in self._buffers_:
+            if len(buffer) >= size and not self._in_use_(buffer):
+                self._buffers_.remove(buffer)
+                self.size -= len(buffer)
+                self.reused += 1
+                return buffer
+        self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buffer=None):
+        if len(buffer) > self.max_buffer_size:
+            return
+        self._buffers_.append(buffer)
+        self.size += len(buffer)
+        while self.size > self.max_bytes:
+            self.size -= len(self._buffers_.popleft())
+
+    def clear(self):
+        self._buffers_.clear()
+        self.size = 0
+
+    def stats(self):
+        return dict(buffers=len(self._buffers_), size=self.size, allocated=self.allocated, reused=self.reused)
+
+
+# the buffers shared by all clients
+BUFFER_POOL = BufferPool()
+
+
+class ResponseBuffer():
+    """
+    Growable bytearray holding the (decompressed) response of an ADDE request.
+    The bytearray is preallocated (size_hint) and grows by doubling, the data is written in place
+    and handed over as a memoryview so no intermediate bytes objects are created.
+    With a pool the bytearray is taken from it and given back by recycle() once the response is handed over.
+    """
+
+    def __init__(self, size_hint=None, pool=None):
+        self.pool = pool
+        size = size_hint or ADDE_READ_CHUNK_SIZE
+        self.buffer = pool.acquire(size) if pool is not None else bytearray(size)
+        self.size = 0
+        self._view_ = None
+
+    def _release_(self):
+        # a bytearray can not be resized while a memoryview is exported
+        if self._view_ is not None:
+            self._view_.release()
+            self._view_ = None
+
+    def reserve(self, nbytes=None):
+        """
+        Make sure nbytes can be written after the current end of data
+        :param nbytes: int
+        """
+        needed = self.size + nbytes
+        capacity = len(self.buffer)
+        if needed > capacity:
+            self._release_()
+            while capacity < needed:
+                capacity *= 2
+            self.buffer.extend(bytes(capacity - len(self.buffer)))
+
+    def tail(self, nbytes=None):
+        """
+        :param nbytes: int, minimum size of the free region
+        :return: a writable memoryview over the free region after the end of data
+        """
+        self.reserve(nbytes)
+        self._release_()
+        self._view_ = memoryview(self.buffer)[self.size:]
+        return self._view_
+
+    def write(self, data=None):
+        n = len(data)
+        self.reserve(n)
+        self.buffer[self.size:self.size + n] = data
+        self.size += n
+
+    def view(self):
+        """
+        :return: read only memoryview over the data
+        """
+        self._release_()
+        return memoryview(self.buffer).toreadonly()[:self.size]
+
+    def recycle(self):
+        """
+        Give the bytearray back to the pool, the views handed over keep it from being reused while they exist
+        """
+        self._release_()
+        if self.pool is not None:
+            self.pool.release(self.buffer)
+            self.pool = None
+
+
+
+class AddeBufferedProtocol(asyncio.BufferedProtocol):
+    """
+    asyncio.BufferedProtocol reading one ADDE response.
+    On the uncompressed ports the socket reads directly into the response buffer. On the compressed port (112)
+    the socket reads into one reusable chunk buffer that is inflated into the response buffer.
+    When an executor is supplied the chunks are inflated in order inside the executor and the reading is paused
+    while too many chunks are waiting to be inflated.
+    The response is available as a memoryview through the done future once the server closes the connection.
+    """
+
+    # max number of chunks waiting to be inflated in the executor before the reading is paused
+    max_pending_chunks = 8
+
+    def __init__(self, compressed=True, size_hint=None, executor=None, pool=None):
+        self.response = ResponseBuffer(size_hint=size_hint, pool=pool)
+        self.inflater = GzipStreamInflater() if compressed else None
+        self.chunk = bytearray(ADDE_READ_CHUNK_SIZE) if compressed else None
+        self.loop = asyncio.get_event_loop()
+        self.done = self.loop.create_future()
+        self.executor = executor
+        self.transport = None
+        self.nbytes = 0
+        self._inflating_ = None
+        self._pending_ = 0
+        self._paused_ = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.inflater is not None:
+            return self.chunk
+        return self.response.tail(ADDE_READ_CHUNK_SIZE)
+
+    def buffer_updated(self, nbytes):
+        self.nbytes += nbytes
+        if self.inflater is None:
+            self.response.size += nbytes
+            return
+        if self.executor is not None:
+            # the chunk buffer is reused so its content is copied before being handed to the executor
+            self._pending_ += 1
+            self._inflating_ = self.loop.create_task(self._inflate_(self._inflating_, bytes(memoryview(self.chunk)[:nbytes])))
+            if self._pending_ >= self.max_pending_chunks and not self._paused_:
+                self._paused_ = True
+                self.transport.pause_reading()
+            return
+        try:
+            self.response.write(self.inflater.inflate(memoryview(self.chunk)[:nbytes]))
+        except zlib.error as e:
+            self._fail_(e)
+
+    async def _inflate_(self, previous=None, data=None):
+        # the chunks are chained so they are inflated in the order they were received
+        if previous is not None:
+            await previous
+        try:
+            self.response.write(await self.loop.run_in_executor(self.executor, self.inflater.inflate, data))
+        except zlib.error as e:
+            self._fail_(e)
+            raise
+        self._pending_ -= 1
+        if self._paused_ and self._pending_ <= self.max_pending_chunks // 2:
+            self._paused_ = False
+            self.transport.resume_reading()
+
+    def _fail_(self, exc=None):
+        logger.error(f'Failed to unzip the response content {self.inflater.head}')
+        if not self.done.done():
+            self.done.set_exception(exc)
+        self.transport.abort()
+
+    def eof_received(self):
+        # returning a false value lets the transport close itself
+        return False
+
+    def connection_lost(self, exc):
+        if self.done.done():
+            return
+        if exc is not None:
+            self.done.set_exception(exc)
+            return
+        if self._inflating_ is not None:
+            self.loop.create_task(self._finish_())
+        else:
+            self._finish_sync_()
+
+    async def _finish_(self):
+        try:
+            await self._inflating_
+        except Exception as e:
+            if not self.done.done():
+                self.done.set_exception(e)
+            return
+        self._finish_sync_()
+
+    def _finish_sync_(self):
+        if self.done.done():
+            return
+        try:
+            if self.inflater is not None:
+                self.response.write(self.inflater.flush())
+        except zlib.error as e:
+            logger.error(f'Failed to unzip the response content {self.inflater.head}')
+            self.done.set_exception(e)
+        else:
+            self.done.set_result(self.response.view())
+
+
+
+class AreaMosaic():
+    """
+    Image assembled on the client, either from several line band aget requests (see AddeClient.aget_tiled)
+    or blown up on the client (aget with positive lmag/emag).
+    Mimics the parts of AreaFile that describe the image. The directory and the navigation are the ones of the
+    top band with the number of lines/elements adjusted to the whole image, data is one array of shape (bands, lines, elements).
+    lmag and emag are the client side magnification factors. The navigation works in image (satellite) coordinates
+    that do not depend on how the area was sampled, a blown up image spans the same image coordinates with lmag
+    times more lines: its line_res/element_res (image lines/elements per pixel) are divided by the magnification,
+    see image_coordinates.
+    A blow up requested with aget(mag_view=True) holds a read only broadcast view of shape
+    (bands, lines, lmag, elements, emag) in data while the directory describes the blown up
+    (bands, lines * lmag, elements * emag) image, data.reshape materializes it.
+    """
+
+    def __init__(self, directory=None, nav=None, data=None, tiles=None, lmag=1, emag=1, origin=None, resolution=None):
+        self.directory = directory
+        self.nav = nav
+        self.data = data
+        # the directories of every line band, top to bottom
+        self.tiles = tiles
+        self.lmag = lmag
+        self.emag = emag
+        # image line/element of the upper left pixel and image lines/elements per pixel, None if unknown
+        self.origin = origin
+        self.resolution = resolution
+
+    def image_coordinates(self, lines=None, elements=None):
+        """
+        Convert the 0 based line/element indices of data into the image coordinates the navigation works in
+        :param lines: number or array
+        :param elements: number or array
+        :return: tuple of 2 float arrays, image lines and image elements
+        """
+        assert self.origin is not None and self.resolution is not None, f'The image coordinates of {self} are unknown'
+        return (self.origin[0] + np.asarray(lines) * self.resolution[0],
+                self.origin[1] + np.asarray(elements) * self.resolution[1])
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(shape={None if self.data is None else self.data.shape}, tiles={len(self.tiles)})'
+
 
 
 class AddeClient():
@@ -37,11 +385,28 @@ class AddeClient():
 
                  trace=0, version=1,#debug args
                  project=0, user='XXXX', password='',  #auth args
-                 conn_timeout=5, adir_timeout=10, aget_timeout= 600# timeout args
-
+                 conn_timeout=5, adir_timeout=10, aget_timeout= 600,# timeout args
+                 transport='stream', # stream (asyncio streams) or buffered (zero copy asyncio.BufferedProtocol)
+                 cache=None, # pyadde.cache.ResponseCache instance
+                 catalog_registry=None, # pyadde.catalog.CatalogRegistry instance, defaults to the process wide registry
+                 executor=None, # concurrent.futures.ThreadPoolExecutor used to inflate and parse the responses
+                 coalesce=True, # identical concurrent adir/aget requests to the server share one transfer and its result
+                 scheduler=None, # pyadde.scheduler.ConnectionScheduler instance, defaults to the process wide scheduler
+                 priority=PRIORITY_DEFAULT, tenant=None, # scheduling args, see pyadde.scheduler
+                 retries=0, retry_backoff=.5, max_retry_backoff=30, # retries of timed out/refused/reset requests
+                 mirrors=None, # other hosts serving the same datasets, tried in order of recent latency
+                 hedge_percentile=None, # send adir/aget to a second host when slower than this latency percentile of the first
+                 latencies=None, # pyadde.failover.LatencyTracker instance, defaults to the process wide tracker
+                 buffer_pool=None # BufferPool instance the buffered transport receives into, defaults to the process wide pool
                  ):
 
         assert host not in [None,''], f'invalid host {host}'
+        assert transport in VALID_TRANSPORTS, f'Invalid transport {transport}. Valid values are {VALID_TRANSPORTS}'
+        # the inflation is stateful (one decompressor per response) and the parsed AreaFile would have to be
+        # pickled back from a process, this is why only thread pools are supported. zlib releases the GIL
+        assert not isinstance(executor, concurrent.futures.ProcessPoolExecutor), f'executor has to be a thread pool'
+        assert retries >= 0, f'Invalid retries {retries}'
+        assert hedge_percentile is None or 0 < hedge_percentile < 100, f'Invalid hedge_percentile {hedge_percentile}'
         self.reader = self.writer = None
         self.generic_args = {}
         for aname, avalue in locals().items():
@@ -51,11 +416,20 @@ class AddeClient():
         for n in  'version', 'trace':
             self.generic_args[n] = getattr(self, n)
         self._binary_content_ = None
+        self.catalog_registry = catalog_registry or CATALOG_REGISTRY
+        self.scheduler = scheduler or CONNECTION_SCHEDULER
+        self.mirrors = tuple(h for h in (mirrors or ()) if h.lower() != host.lower())
+        self.latencies = latencies or HOST_LATENCIES
+        self.buffer_pool = buffer_pool or BUFFER_POOL
 
 
     async def __aenter__(self):
-        self.content = self._parse_pubsrv_response_(await self.binary_content())
-        self.groups = self._extract_groups_(self.content)
+        # the catalog is shared by all the clients of a server, it is fetched and parsed only once
+        entry = await self.catalog_registry.entry(self)
+        self._binary_content_ = entry.binary_content
+        self.content = entry.content
+        self.catalog = entry.catalog
+        self.groups = self._extract_groups_()
         self.group_names = tuple([e[0] for e in self.groups])
         #self.sat_bands = await self.satbands()
 
@@ -69,29 +443,27 @@ class AddeClient():
         pass #because the server does not reuse the socket, the requests are made inside one function from scratch every time, that means they are closed theer as well
 
 
-    async def close(self):
-        if self.reader:
-            if not self.reader.at_eof():
-                self.reader.feed_eof()
+    async def close(self, reader=None, writer=None):
+        reader = reader or self.reader
+        writer = writer or self.writer
+        if reader:
+            if not reader.at_eof():
+                reader.feed_eof()
 
-        if self.writer:
+        if writer:
             logger.debug(f'Closing connection to {self.host}')
-            self.writer.close()
+            writer.close()
 
     def json_content(self):
         import json
         d = {'server': self.host}
-        glist = []
-        for gname, gformat in self.groups:
-            descr = self._extract_descriptors_(group_name=gname)
-            glist.append({gname:{'format':gformat,'descriptors':dict(descr)}})
-
-        d['groups'] = glist
+        d['groups'] = self.catalog.to_dict()
         return json.dumps(d,indent=4)
 
-    def _create_bin_req_(self, req_type=None, req_text=None, ): #project: 1234, 6999, 0, user: 'XXXX
+    def _create_bin_req_(self, req_type=None, req_text=None, host=None): #project: 1234, 6999, 0, user: 'XXXX
         assert req_type is not None, 'invalid req type'
-        logger.debug(f'creating bin req "{req_type} {req_text}" to {self.host}')
+        host = host or self.host
+        logger.debug(f'creating bin req "{req_type} {req_text}" to {host}')
 
         prj = int(self.project)
 
@@ -99,7 +471,7 @@ class AddeClient():
         local_ip_int = [127, 0, 1, 1]
 
 
-        server_ip_int = util.host2int(self.host)
+        server_ip_int = util.host2int(host)
 
         version = struct.pack('>i', 1)
 
@@ -139,81 +511,290 @@ class AddeClient():
 
         return preamble + req_body
 
-    async def _query_server_(self, req_type=None, req_text=None, read_in_chunks=False, timeout=None):
+    async def _query_server_(self, req_type=None, req_text=None, read_in_chunks=False, timeout=None, size_hint=None):
+        """
+        Send a request to the server and return the decompressed response.
+        The response is served from the cache when the client has one and the request was made before.
+        Timed out, refused, reset and truncated requests are retried with a jittered exponential backoff, every retry
+        going to the next host of the client host and its mirrors ranked by recent latency.
+        :param req_type: str, adir, aget, txtg
+        :param req_text: str, the request text
+        :param read_in_chunks: kept for backward compatibility, the response is always read in chunks
+        :param timeout: number, the max number of seconds the transfer can take
+        :param size_hint: int, expected size of the decompressed response
+        :return: bytes like, decompressed response
+        """
+        hosts = (self.host,) + self.mirrors
+        if self.cache is not None:
+            # the mirrors serve the same datasets, a response of any of them will do
+            for host in hosts:
+                data = self.cache.get(host=host, port=self.port, req_type=req_type, req_text=req_text)
+                if data is not None:
+                    return data
+
+        if self.mirrors:
+            hosts = tuple(self.latencies.rank(hosts=hosts, req_type=req_type))
+        attempt = 0
+        while True:
+            host = hosts[attempt % len(hosts)]
+            try:
+                if self.hedge_percentile is not None and len(hosts) > 1 and req_type in ('adir', 'aget'):
+                    data = await self._query_hedged_(
+                        hosts=(host, hosts[(attempt + 1) % len(hosts)]), req_type=req_type, req_text=req_text,
+                        timeout=timeout, size_hint=size_hint)
+                else:
+                    data = await self._query_host_(host=host, req_type=req_type, req_text=req_text, timeout=timeout, size_hint=size_hint)
+                break
+            except RETRIABLE_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                # the next attempt goes to the next mirror
+                delay = backoff_delay(attempt=attempt, base=self.retry_backoff, max_delay=self.max_retry_backoff)
+                logger.warning(f'{req_type} req to {host} failed ({e.__class__.__name__}), retrying in {delay:.2f} s')
+                await asyncio.sleep(delay)
+                attempt += 1
+        return data
+
+    async def _query_host_(self, host=None, req_type=None, req_text=None, timeout=None, size_hint=None):
+        """
+        Send a request to one host, the latency is recorded for the ranking of the mirrors and the hedging
+        :return: bytes like, decompressed response
+        """
+        bin_req = self._create_bin_req_(req_type=req_type, req_text=req_text, host=host)
 
-        bin_req  = self._create_bin_req_(req_type=req_type, req_text=req_text)
+        # every connection goes through the shared scheduler that enforces the per host/global limits
+        try:
+            async with self.scheduler.slot(host=host, priority=self.priority, tenant=self.tenant) as slot:
+                logger.debug(f'{req_type} req to {host} waited {slot.wait_time:.3f} s for a connection')
+                if self.transport == 'buffered':
+                    data = await self._query_server_buffered_(req_type=req_type, bin_req=bin_req, timeout=timeout, size_hint=size_hint, host=host)
+                else:
+                    data = await self._query_server_stream_(req_type=req_type, bin_req=bin_req, timeout=timeout, host=host)
+                slot.nbytes = len(data) if data is not None else 0
+        except RETRIABLE_ERRORS:
+            self.latencies.failure(host=host)
+            raise
+        logger.debug(f'{req_type} req to {host} held its connection {slot.transfer_time:.3f} s')
+        self.latencies.record(host=host, req_type=req_type, latency=slot.transfer_time)
+        if self.cache is not None:
+            # keyed on the host that answered
+            self.cache.put(host=host, port=self.port, req_type=req_type, req_text=req_text, data=data)
+        return data
+
+    async def _query_hedged_(self, hosts=None, req_type=None, req_text=None, timeout=None, size_hint=None):
+        """
+        Send a request to the first host and, if it has not answered once the hedge_percentile of its recent
+        latencies has passed, send it to the second host as well. The first response wins and the other request is cancelled
+        :param hosts: tuple of two hosts
+        :return: bytes like, decompressed response
+        """
+        primary, secondary = hosts
+        args = dict(req_type=req_type, req_text=req_text, timeout=timeout, size_hint=size_hint)
+        delay = self.latencies.percentile(host=primary, req_type=req_type, q=self.hedge_percentile)
+        pending = {asyncio.ensure_future(self._query_host_(host=primary, **args))}
+        try:
+            if delay is not None:
+                done, pending = await asyncio.wait(pending, timeout=delay)
+                if done:
+                    return done.pop().result()
+                logger.debug(f'{req_type} req to {primary} is slower than {delay:.3f} s, hedging it to {secondary}')
+                pending.add(asyncio.ensure_future(self._query_host_(host=secondary, **args)))
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+                if not pending:  # the last request standing raises its error
+                    return done.pop().result()
+        finally:
+            for task in pending:
+                task.cancel()
+            # the cancelled requests release their connections and scheduler slots before returning
+            await asyncio.gather(*pending, return_exceptions=True)
 
+    async def _query_server_stream_(self, req_type=None, bin_req=None, timeout=None, host=None):
+        """
+        Send a binary request and receive the response using asyncio streams.
+        :param req_type: str, the request type, used for logging
+        :param bin_req: bytes, the binary request created by _create_bin_req_
+        :param timeout: number, the max number of seconds the transfer can take
+        :param host: str, defaults to the host of the client
+        :return: bytes, decompressed response
+        """
+        host = host or self.host
+        reader = writer = None
         try:
             '''
             ADDE protocol is stateless 100%, that simply means that after servicing a given request the rerver
             sends an RST and closes down. No other fancy stuff. This is why the next to lines are here and not in __init__ and __aenter__
             
             '''
-            self.con = asyncio.open_connection(host=self.host, port=self.port)
-            self.reader, self.writer = await asyncio.wait_for(self.con, timeout=self.conn_timeout)
-            logger.debug(f'New connection to {self.host} was opened')
+            # the streams are local so concurrent requests made by the same client do not share them
+            con = asyncio.open_connection(host=host, port=self.port)
+            reader, writer = await asyncio.wait_for(con, timeout=self.conn_timeout)
+            logger.debug(f'New connection to {host} was opened')
             with io.BytesIO() as total_data:
-
+                # the port 112 responses are gzipped. Every chunk is inflated as soon as it arrives so
+                # the decompression overlaps with the transfer and the compressed response is never buffered whole
+                inflater = GzipStreamInflater() if self.port == 112 else None
+                dl = 0
                 try:
                     # send binary req to server
-                    self.writer.write(bin_req)
+                    writer.write(bin_req)
 
                     # flush
-                    await self.writer.drain()
+                    await writer.drain()
                     with async_timeout.timeout(timeout=timeout):
-                        if not read_in_chunks:
-                            # # read at once
-                            data = await self.reader.read()
-
-                            total_data.write(data)
-                        else:
-                            # read in chunks
-                            while True:
-                                data = await self.reader.read(ADDE_READ_CHUNK_SIZE)
-                                if not data:  # client is diconneted
-                                    break
+                        # the response is always read in chunks, read_in_chunks is kept for backward compatibility
+                        # with an executor a chunk is inflated in the executor while the next one is read
+                        inflating = None
+                        while True:
+                            data = await reader.read(ADDE_READ_CHUNK_SIZE)
+                            if inflating is not None:
+                                total_data.write(await inflating)
+                                inflating = None
+                            if not data:  # client is diconneted
+                                break
+                            dl += len(data)
+                            if inflater is None:
                                 total_data.write(data)
-                    dl = total_data.tell()
+                            elif self.executor is None:
+                                total_data.write(inflater.inflate(data))
+                            else:
+                                inflating = asyncio.get_event_loop().run_in_executor(self.executor, inflater.inflate, data)
+                        if inflater is not None:
+                            total_data.write(inflater.flush())
 
                 except TimeoutError:
-                    logger.error(f'{req_type} req to {self.host} has timed out!')
+                    logger.error(f'{req_type} req to {host} has timed out!')
+                    raise
+                except zlib.error:
+                    logger.error(f'Failed to unzip the response content {inflater.head} of {req_type} request')
                     raise
                 except Exception as eee:
                     logger.error(f'Exception {eee.__class__.__name__}: {str(eee)} occured in {req_type} ')
                     raise
 
                 if self.port == 112:
-
-                    try:
-                        total_data.seek(0)
-                        decf = gzip.GzipFile(fileobj=total_data, mode='rb', )
-                        data = decf.read()
-                        ucdl = len(data)
-                        logger.debug(
-                            f'server {self.host} has sent {dl} compressed bytes decompressed into {ucdl} bytes  {ucdl/2**20} MB')
-                        return data
-                    except IOError:
-                        total_data.seek(0)
-                        v = total_data.getvalue()
-
-                        if len(v) > 1000:
-                            v = v[:1000]
-                        logger.error(f'Failed to unzip the response content {v} of adir request')
-                        raise
+                    ucdl = total_data.tell()
+                    logger.debug(
+                        f'server {host} has sent {dl} compressed bytes decompressed into {ucdl} bytes  {ucdl/2**20} MB')
+                    # getvalue() hands over the internal buffer without copying it
+                    return total_data.getvalue()
 
         except (asyncio.TimeoutError, ConnectionRefusedError) as re:
-            logger.error(f'Issues ({re}) connecting to host {self.host}')
+            logger.error(f'Issues ({re}) connecting to host {host}')
             raise
 
         except Exception as e:
             logger.error(e)
             raise
         finally:
-            await self.close()
+            await self.close(reader=reader, writer=writer)
+
+    async def _query_server_buffered_(self, req_type=None, bin_req=None, timeout=None, size_hint=None, host=None):
+        """
+        Send a binary request and receive the response using AddeBufferedProtocol.
+        :param req_type: str, the request type, used for logging
+        :param bin_req: bytes, the binary request created by _create_bin_req_
+        :param timeout: number, the max number of seconds the transfer can take
+        :param size_hint: int, expected size of the decompressed response, used to preallocate the response buffer
+        :param host: str, defaults to the host of the client
+        :return: memoryview over the decompressed response
+        """
+        host = host or self.host
+        loop = asyncio.get_event_loop()
+        protocol = AddeBufferedProtocol(compressed=self.port == 112, size_hint=size_hint, executor=self.executor,
+                                        pool=self.buffer_pool)
+        try:
+            transport, _ = await asyncio.wait_for(
+                loop.create_connection(lambda: protocol, host=host, port=self.port), timeout=self.conn_timeout)
+        except (asyncio.TimeoutError, ConnectionRefusedError) as re:
+            logger.error(f'Issues ({re}) connecting to host {host}')
+            raise
+        logger.debug(f'New connection to {host} was opened')
+        try:
+            transport.write(bin_req)
+            with async_timeout.timeout(timeout=timeout):
+                data = await protocol.done
+            ucdl = len(data)
+            logger.debug(
+                f'server {host} has sent {protocol.nbytes} bytes decompressed into {ucdl} bytes  {ucdl/2**20} MB')
+            # the connection is closed and every chunk inflated, nothing writes into the buffer anymore
+            protocol.response.recycle()
+            return data
+        except asyncio.TimeoutError:
+            logger.error(f'{req_type} req to {host} has timed out!')
+            raise
+        except Exception as eee:
+            logger.error(f'Exception {eee.__class__.__name__}: {str(eee)} occured in {req_type} ')
+            raise
+        finally:
+            logger.debug(f'Closing connection to {host}')
+            transport.close()
+
 
 
 
 
+    async def _iter_server_(self, req_type=None, req_text=None, timeout=None):
+        """
+        Send a request to the server and yield the decompressed response as it arrives.
+        The streams are not retried and do not fail over to the mirrors: part of the response may already have
+        been consumed when the connection fails, the error is raised to the consumer instead.
+        :param req_type: str, adir, aget, txtg
+        :param req_text: str, the request text
+        :param timeout: number, the max number of seconds the transfer can take (not counting the time
+                spent by the consumer between the chunks)
+        :return: async iterator of bytes chunks
+        """
+        bin_req = self._create_bin_req_(req_type=req_type, req_text=req_text)
+        loop = asyncio.get_event_loop()
+        inflater = GzipStreamInflater() if self.port == 112 else None
+        reader = writer = None
+        slot = self.scheduler.slot(host=self.host, priority=self.priority, tenant=self.tenant)
+        await slot.__aenter__()
+        error = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host=self.host, port=self.port), timeout=self.conn_timeout)
+            logger.debug(f'New connection to {self.host} was opened')
+            writer.write(bin_req)
+            await writer.drain()
+            remaining = timeout
+            while True:
+                started = loop.time()
+                data = await asyncio.wait_for(reader.read(ADDE_READ_CHUNK_SIZE), timeout=remaining)
+                if remaining is not None:
+                    remaining = max(remaining - (loop.time() - started), 0)
+                if not data:  # client is diconneted
+                    break
+                slot.nbytes += len(data)
+                if inflater is not None:
+                    data = await self._run_blocking_(inflater.inflate, data)
+                if data:
+                    yield data
+            if inflater is not None:
+                data = inflater.flush()
+                if data:
+                    yield data
+        except (asyncio.TimeoutError, ConnectionRefusedError) as re:
+            error = re
+            logger.error(f'Issues ({re}) with {req_type} req to host {self.host}')
+            raise
+        except zlib.error as e:
+            error = e
+            logger.error(f'Failed to unzip the response content {inflater.head} of {req_type} request')
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await self.close(reader=reader, writer=writer)
+            # the exception of the stream, sys.exc_info() could return one the consumer is handling
+            if error is None:
+                await slot.__aexit__(None, None, None)
+            else:
+                await slot.__aexit__(type(error), error, error.__traceback__)
 
     def _parse_pubsrv_response_(self, bin_response=None):
 
@@ -250,7 +831,7 @@ class AddeClient():
 
 
         if nbytes == 0 or len(bin_response)==96:  # something went wrong
-            msg = ''.join([e for e in bin_response[12:12 + 72].decode('utf-8') if e.isalpha() or e == ' '])
+            msg = ''.join([e for e in bytes(bin_response[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
             #msg = data_in[12:12 + 72]
             raise Exception(msg)  # should still be 96 bytes with the error
 
@@ -321,7 +902,7 @@ class AddeClient():
         n = 0
         j = 0
         if numbytes == 0:  # something went wrong
-            msg = ''.join([e for e in bin_response[12:12 + 72].decode('utf-8') if e.isalpha() or e == ' '])
+            msg = ''.join([e for e in bytes(bin_response[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
             raise Exception(msg)  # should still be 96 bytes with the error
 
 
@@ -334,6 +915,7 @@ class AddeClient():
 
             ad = area_directory(dir_bytes=adir_bytes)
 
+            csize = 0
             if ad.comment_count > 0:
                 # cards hold info that can be eventually used (lat lon, res) or just some other staff maybe even bogus
                 csize = ad.comment_count*80
@@ -354,7 +936,7 @@ class AddeClient():
         numbytes = int.from_bytes(bin_response[:4],'big')
 
         if numbytes == 0:  # something went wrong
-            msg = ''.join([e for e in bin_response[12:12 + 72].decode('utf-8') if e.isalpha() or e == ' '])
+            msg = ''.join([e for e in bytes(bin_response[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
             raise Exception(msg)  # should still be 96 bytes with the error
         else:
             return AreaFile(source=bin_response[4:])
@@ -364,49 +946,54 @@ class AddeClient():
 
     def _extract_groups_(self, only_image=True):
         """
-        Extract the ADDE groups from an iterator of dictinaries generated by parse_pubsrv_response from a PUBLIC.SRV text file
-        :param parsed_lines: iter of dicts
-        :return: iter(str) with groups
+        Extract the ADDE groups from the indexed catalog built from the PUBLIC.SRV text file
+        :param only_image: bool, consider only the IMAGE datasets
+        :return: iter((str, str)) with groups and their format
         """
-        if only_image:
-            return tuple(set([(d['N1'], d['K']) for d in self.content if
-                              ('N1' in d.keys() and 'N2' in d.keys() and 'TYPE' in d.keys()) and d['TYPE'] == 'IMAGE']))
-        else:
-            return tuple(set([(d['N1'], d['K'] )for d in self.content if
-                              ('N1' in d.keys() and 'N2' in d.keys() and 'TYPE' in d.keys())]))
+        return self.catalog.groups(only_image=only_image)
 
     def _extract_descriptors_(self, group_name=None, only_image=True):
         """
-        Extract the ADDE groups from an iterator of dictionaris generated by parse_pubsrv_response from a PUBLIC.SRV text file
-        :param parsed_lines: iter of dicts
-        :return: iter(str) with IMAGE descriptors for a the supplied group
+        Extract the descriptors of a group from the indexed catalog built from the PUBLIC.SRV text file
+        :param group_name: str, the group, case insensitive
+        :param only_image: bool, consider only the IMAGE datasets
+        :return: iter((str, str)) with IMAGE descriptors for a the supplied group and their comment
         """
         assert group_name, 'The group argument can not be None or ""'
-        groups = self._extract_groups_( only_image=only_image)
-        assert group_name in [e[0] for e in groups], 'The group {0} does not exist on ADDE server. Existing groups are {1}'.format(group_name, str(groups))
-        if only_image:
-            return tuple(set([(d['N2'], d['C'] if 'C' in d else '') for d in self.content if
-                              ('N1' in d.keys() and 'N2' in d.keys() and 'TYPE' in d.keys()) and (
-                                      d['N1'].lower() == group_name.lower() and d['TYPE'] == 'IMAGE')]))
-        else:
-            return tuple(set([(d['N2'], d['C'] if 'C' in d else '') for d in self.content if
-                              ('N1' in d.keys() and 'N2' in d.keys()  and 'TYPE' in d.keys()) and (
-                                      d['N1'].lower() == group_name.lower())]))
+        assert self.catalog.has_group(group_name=group_name, only_image=only_image), 'The group {0} does not exist on ADDE server. Existing groups are {1}'.format(group_name, str(self._extract_groups_(only_image=only_image)))
+        return tuple((info.name, info.comment) for info in self.catalog.descriptors(group_name=group_name, only_image=only_image))
 
+    def _validate_dataset_(self, group=None, descriptor=None):
+        """
+        Check the group and the descriptor exist on the server (case insensitive)
+        :param group: str, ADDE group
+        :param descriptor: str, ADDE descriptor
+        """
+        assert self.catalog.has_group(group_name=group), f'Invalid group {group}. Valid groups on {self.host} are {self.group_names}'
+        assert self.catalog.descriptor(group_name=group, descriptor_name=descriptor) is not None, \
+            f'Invalid descpritor {descriptor} for group {group}. Valid descriptors are {tuple(e[0] for e in self._extract_descriptors_(group_name=group))}'
 
     async def binary_content(self):
         if self._binary_content_ is None:
-            grp = descr = 'null'
-            req_type = 'txtg'
-            text_req = f'{grp} {descr} FILE=RESOLV.SRV'
+            entry = await self.catalog_registry.entry(self)
+            self._binary_content_ = entry.binary_content
 
-            self._binary_content_ = await self._query_server_(req_type=req_type, req_text=text_req)
-            if  self._binary_content_ is None:
-                text_req = f'{grp} {descr} FILE=PUBLIC.SRV'
-                self._binary_content_ = await self._query_server_(req_type=req_type, req_text=text_req)
+        return self._binary_content_
 
+    async def _fetch_binary_content_(self):
+        """
+        Request the catalog (RESOLV.SRV or PUBLIC.SRV) from the server. Used by the catalog registry.
+        :return: the decompressed response
+        """
+        grp = descr = 'null'
+        req_type = 'txtg'
+        text_req = f'{grp} {descr} FILE=RESOLV.SRV'
 
-        return self._binary_content_
+        binary_content = await self._query_server_(req_type=req_type, req_text=text_req)
+        if  binary_content is None:
+            text_req = f'{grp} {descr} FILE=PUBLIC.SRV'
+            binary_content = await self._query_server_(req_type=req_type, req_text=text_req)
+        return binary_content
 
     async def satbands(self):
         grp = descr = 'null'
@@ -418,7 +1005,7 @@ class AddeClient():
 
 
         if numbytes == 0:  # something went wrong
-            msg = ''.join([e for e in bin_response[12:12 + 72].decode('utf-8') if e.isalpha() or e == ' '])
+            msg = ''.join([e for e in bytes(bin_response[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
             raise Exception(msg)  # should still be 96 bytes with the error
 
         offset =8
@@ -474,10 +1061,7 @@ class AddeClient():
         assert group is not None, f'group  can not be {group}'
         assert descriptor is not None, f'descriptor can not be {descriptor}'
         assert position is not None, f'position can not be {position}'
-        assert group in self.group_names, f'Invalid group {group}. Valid groups on {self.host} are {self.group_names}'
-        valid_descr = tuple([e[0] for e in self._extract_descriptors_(group_name=group)])
-        assert descriptor in valid_descr, f'Invalid descpritor {descriptor} for group {group}. Valid descriptors are {valid_descr}'
-        del valid_descr
+        self._validate_dataset_(group=group, descriptor=descriptor)
         assert band is not None, f'Invalid band {band}'
 
 
@@ -592,11 +1176,88 @@ class AddeClient():
 
 
 
-        bin_resp = await self._query_server_(req_type='adir', req_text=req_text, timeout=self.adir_timeout)
+        async def request():
+            bin_resp = await self._query_server_(req_type='adir', req_text=req_text, timeout=self.adir_timeout)
+
+            adirs = self._parse_adir_response_(bin_response=bin_resp)
 
+            for adir in adirs:
+                self._annotate_directory_(adir, group=group, descriptor=descriptor, day=day)
+            return adirs
+
+        # the list is copied so the callers sharing the response can not alter it for the others
+        return list(await self._single_flight_(kind='adir', req_text=req_text, factory=request))
+
+    async def adir_stream(self,
+                          group=None, descriptor=None, position=None,
+                          band=None, day=None, stime=None, etime=None,
+                          aux=None, ordered=False
+                          ):
+        """
+        Request image headers and yield every directory as soon as its record
+        (size, area number, 256-byte directory, comment cards) was received and decompressed.
+        Large listings (position='ALL' on archive servers) can be processed while they are still downloading.
+        Unlike adir, the request is neither retried nor sent to the mirrors of the client (see _iter_server_).
+
+            async for adir in client.adir_stream(group='RTGOESR', descriptor='FD', position='ALL', band=2, ...):
+                ...
+
+        The args are the same as in adir
+        :param ordered: bool, if True the directories are collected and yielded sorted by nominal time
+                (same as adir), otherwise they are yielded in the order the server sends them
+        :return: async iterator of area_directory objects
+        """
+        if ordered:
+            for adir in await self.adir(group=group, descriptor=descriptor, position=position,
+                                        band=band, day=day, stime=stime, etime=etime, aux=aux):
+                yield adir
+            return
 
-        adirs = self._parse_adir_response_(bin_response=bin_resp)
+        req_text = self._compose_adir_req_text_(
+            group=group, descriptor=descriptor, position=position,
+            band=band, day=day, stime=stime, etime=etime, aux=aux
+        )
+        chunks = self._iter_server_(req_type='adir', req_text=req_text, timeout=self.adir_timeout)
+        pending = bytearray()
+        first = True
+        try:
+            async for chunk in chunks:
+                pending.extend(chunk)
+                offset = 0
+                # parse all the complete records
+                while len(pending) - offset >= 4:
+                    numbytes = int.from_bytes(pending[offset:offset + 4], 'big')
+                    if numbytes == 0:
+                        if first:  # something went wrong
+                            if len(pending) < 96:
+                                break
+                            msg = ''.join([e for e in bytes(pending[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
+                            raise Exception(msg)  # should still be 96 bytes with the error
+                        return  # the end of the listing
+                    end = offset + 4 + numbytes
+                    if len(pending) < end:
+                        break
+                    first = False
+                    dir_start = offset + 8
+                    dir_end = dir_start + AD_DIRSIZE
+                    ad = area_directory(dir_bytes=bytes(pending[dir_start:dir_end]))
+                    if ad.comment_count > 0:
+                        ad.add_comments(comment_bytes=bytes(pending[dir_end:dir_end + ad.comment_count * 80]))
+                    self._annotate_directory_(ad, group=group, descriptor=descriptor, day=day)
+                    yield ad
+                    offset = end
+                del pending[:offset]
+            if first:
+                raise Exception(f'Empty adir response from {self.host}')
+            # the listing ends with a 0 size record, the response was cut before it
+            raise TruncatedResponseError(f'The adir response from {self.host} ended before the end of the listing')
+        finally:
+            await chunks.aclose()
 
+    def _annotate_directory_(self, adir=None, group=None, descriptor=None, day=None):
+        """
+        Add the request info to a directory returned by the server
+        """
         # all the other
         extra_args = list()
         for e, ev in sorted(self.generic_args.items()):
@@ -604,10 +1265,142 @@ class AddeClient():
                 extra_args.append(f'{e.upper()}={str(ev).upper()}')
         # extra_args.append(f'NAV=X')
         extra_str = ' '.join(extra_args) or ''
-        for adir in adirs:
-            sts = adir.start_time.time()
-            adir.text_request = f'adde://{self.host}/adir/{group} {descriptor} BAND={adir.bands[0]} DAY={day} TIME={sts} {sts} {extra_str}'
-        return adirs
+        sts = adir.start_time.time()
+        adir.text_request = f'adde://{self.host}/adir/{group} {descriptor} BAND={adir.bands[0]} DAY={day} TIME={sts} {sts} {extra_str}'
+        # keep the dataset so the directory can be used later as a request spec (aget_many/adir_many)
+        adir.group = group
+        adir.descriptor = descriptor
+
+    async def adir_table(self,
+                         group=None, descriptor=None, position=None,
+                         band=None, day=None, stime=None, etime=None,
+                         aux=None,
+                         ):
+        """
+        Request image headers as a columnar table. Same as adir but the response is parsed in a vectorized manner
+        into an AreaDirectoryTable which is much faster for large listings (position='ALL').
+        The area_directory objects are created only for the rows that are accessed.
+
+            table = await client.adir_table(group='RTGOESR', descriptor='FD', position='ALL', band=2, ...)
+            recent = table.filter(table.lines > 1000).sort('nominal_time', reverse=True)
+            adir = recent[0]
+
+        args are the same as in adir
+        :return: AreaDirectoryTable sorted by nominal time
+        """
+        req_text = self._compose_adir_req_text_(
+            group=group, descriptor=descriptor, position=position,
+            band=band, day=day, stime=stime, etime=etime, aux=aux
+        )
+        async def request():
+            bin_resp = await self._query_server_(req_type='adir', req_text=req_text, timeout=self.adir_timeout)
+            table = AreaDirectoryTable.from_response(
+                bin_response=bin_resp,
+                annotate=functools.partial(self._annotate_directory_, group=group, descriptor=descriptor, day=day)
+            )
+            return table.sort('nominal_time')
+
+        return await self._single_flight_(kind='adir_table', req_text=req_text, factory=request)
+
+    async def _single_flight_(self, kind=None, req_text=None, factory=None):
+        """
+        Coalesce identical concurrent requests made by any client to the same server
+        :param kind: str, identifies what factory returns (adir, adir_table, aget)
+        :param req_text: str, request text
+        :param factory: coroutine function performing the request and parsing the response
+        :return: the result of factory(), shared by all the callers of an identical request
+        """
+        if not self.coalesce:
+            return await factory()
+        key = (kind, self.user, self.project, self.transport,
+               canonical_request(host=self.host, port=self.port, req_type=kind, req_text=req_text))
+        return await INFLIGHT_REQUESTS.do(key=key, factory=factory)
+
+    def _directory_request_args_(self, directory=None):
+        """
+        Convert an area_directory returned by adir into request args pinned to its start time
+        :param directory: area_directory instance returned by adir
+        :return: dict, adir/aget args
+        """
+        try:
+            group, descriptor = directory.group, directory.descriptor
+        except AttributeError:
+            raise Exception(f'The directory {directory} was not returned by adir and can not be used as a request spec')
+        return dict(
+            group=group, descriptor=descriptor, position=0,
+            band=' '.join(map(str, directory.bands)),
+            day=directory.start_time.date(), stime=str(directory.start_time.time()), etime=str(directory.start_time.time())
+        )
+
+    async def _run_many_(self, func=None, requests=None, max_concurrency=None, extra_args=None):
+        """
+        Run func for every request spec with at most max_concurrency requests in flight
+        and yield the results in completion order.
+        :param func: coroutine function, adir or aget
+        :param requests: iterable of dicts (func kwargs) or area_directory instances returned by adir
+        :param max_concurrency: int, max number of concurrent requests
+        :param extra_args: dict, args applied to every directory spec (not to dict specs)
+        :return: async iterator of (spec, result) tuples. In case a request failed the result is the exception instance.
+        """
+        assert max_concurrency is None or max_concurrency > 0, f'Invalid max_concurrency {max_concurrency}'
+        specs = iter(requests)
+        pending = dict()
+
+        def schedule():
+            while max_concurrency is None or len(pending) < max_concurrency:
+                try:
+                    spec = next(specs)
+                except StopIteration:
+                    return
+                if isinstance(spec, dict):
+                    kwargs = spec
+                else:
+                    kwargs = self._directory_request_args_(directory=spec)
+                    kwargs.update(extra_args or {})
+                pending[asyncio.ensure_future(func(**kwargs))] = spec
+
+        schedule()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    spec = pending.pop(task)
+                    exc = task.exception()
+                    if exc is not None:
+                        logger.error(f'Request {spec} to {self.host} failed with {exc.__class__.__name__}: {exc}')
+                        yield spec, exc
+                    else:
+                        yield spec, task.result()
+                schedule()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def adir_many(self, requests=None, max_concurrency=4):
+        """
+        Issue many adir requests with bounded concurrency.
+        :param requests: iterable of dicts holding adir args or area_directory instances returned by adir
+        :param max_concurrency: int, max number of concurrent requests to the server
+        :return: async iterator of (spec, result) tuples in completion order.
+                 One failing request does not stop the batch, its result is the exception instance.
+
+            async for spec, adirs in client.adir_many(specs, max_concurrency=4):
+                if isinstance(adirs, Exception):
+                    ...
+        """
+        return self._run_many_(func=self.adir, requests=requests, max_concurrency=max_concurrency, extra_args=dict(aux='YES'))
+
+    def aget_many(self, requests=None, max_concurrency=4, **aget_args):
+        """
+        Issue many aget requests with bounded concurrency.
+        :param requests: iterable of dicts holding aget args or area_directory instances returned by adir
+        :param max_concurrency: int, max number of concurrent requests to the server
+        :param aget_args: aget args applied to the area_directory specs (unit, lmag, emag, etc.)
+        :return: async iterator of (spec, result) tuples in completion order.
+                 One failing request does not stop the batch, its result is the exception instance.
+        """
+        return self._run_many_(func=self.aget, requests=requests, max_concurrency=max_concurrency, extra_args=aget_args)
 
 
 
@@ -637,15 +1430,13 @@ class AddeClient():
         #blow ups are done on the client to conserve transmission bandwidth (default=1);
         # values must be integers; negative numbers mean a blowdown must be performed
         #in order to be prefectly accurate the clent should handle blow-up.!!!!
-        #TODO handle blowup . I guess blo
+        #the server is asked for the unmagnified image and aget blows it up (see AddeClient._magnify_area_)
 
         if lmag is not None:
             lmagi = int(lmag)
             if lmagi < 0:
                 nlines = nlines // abs(lmagi)  # seems like whatever the sign of mag the aget does only downsampling??
-            else: # let's ignore pos mag aka blowup.
-                #nlines = nlines * abs(lmagi)
-
+            else: # pos mag aka blowup is done by the client
                 lmag = 1
 
 
@@ -654,7 +1445,6 @@ class AddeClient():
             if emagi < 0:
                 nelems = nelems // abs(emagi)  # seems like whatever the sign of mag the aget does only downsampling??
             else:
-                #nelems = nelems * abs(emagi)
                 emag = 1
 
         # create the LOCATE from coord_type, coord_pos, coord_start_dim1, coord_start_dim2, nlin, nele
@@ -704,8 +1494,7 @@ class AddeClient():
                    day=None, stime=None, etime=None,
                    band=None, unit=None, spac='X', cal='X',
                    lmag=1, emag=1, doc='YES', aux='YES',
-
-
+                   mag_view=False
 
                    ):
         """
@@ -738,7 +1527,11 @@ class AddeClient():
         :param emag: element magnification factor, blow ups are done on the client to conserve transmission bandwidth (default=1) values must be integers; negative numbers mean a blowdown must be performed
         :param doc: if YES, include the line documentation block default on server=NO
         :param aux: if YES, additional calibration information is sent, default on server=NO
-        :return: an instance of McIDAS Area file object
+        :param mag_view: bool, if True a blow up is returned as a zero copy broadcast view of shape
+                (bands, lines, lmag, elements, emag) instead of a materialized (bands, lines*lmag, elements*emag) array,
+                the directory of the result describes the materialized shape
+        :return: an instance of McIDAS Area file object or an AreaMosaic if the image was blown up (positive lmag/emag).
+                When the client coalesces requests, identical concurrent requests share the same instance
 
         ADDE server features inconsistent behaviour for band keyword
         in adir the band can be ALL, in or two ints. When the band is expreseed as 2 numbers the server will return
@@ -748,16 +1541,139 @@ class AddeClient():
 
         #is three numbers are
         """
+        req_text, nlines, nelems = await self._prepare_aget_(
+            group=group, descriptor=descriptor, position=position,
+            coord_type=coord_type, coord_pos=coord_pos, coord_start_dim1=coord_start_dim1, coord_start_dim2=coord_start_dim2,
+            nlines=nlines, nelems=nelems,
+            day=day, stime=stime, etime=etime, band=band,
+            unit=unit, spac=spac, cal=cal,
+            lmag=lmag, emag=emag, doc=doc, aux=aux
+        )
+
+
+
+        # the number of pixels is a lower bound for the size of the response and is used to preallocate the buffers
+        size_hint = nlines * nelems if isinstance(nlines, int) and isinstance(nelems, int) else None
+
+        async def request():
+            bin_resp = await self._query_server_(req_type='aget', req_text=req_text, timeout=self.aget_timeout,read_in_chunks=False, size_hint=size_hint)
+
+            area_file = await self._run_blocking_(self._parse_aget_response_, bin_resp)
+            lmagi, emagi = max(int(lmag), 1), max(int(emag), 1)
+            if lmagi > 1 or emagi > 1:
+                words = struct.unpack('>64i', bin_resp[4:4 + AD_DIRSIZE])
+                return await self._run_blocking_(self._magnify_area_, area_file, lmagi, emagi, mag_view, words)
+            return area_file
+
+        return await self._single_flight_(kind=f'aget{mag_view}', req_text=req_text, factory=request)
+
+    async def aget_stream(self,
+                          group=None, descriptor=None, position=None,  #dataset args
+                          coord_type='A', coord_pos='U', coord_start_dim1=None, coord_start_dim2=None,  #coord args
+                          nlines=None, nelems=None,   #image props
+                          day=None, stime=None, etime=None,
+                          band=None, unit=None, spac='X', cal='X',
+                          lmag=1, emag=1, doc='YES', aux='YES',
+                          block_lines=256
+                          ):
+        """
+        Request image data and yield it in blocks of lines as soon as they are received and decompressed.
+        The AREA directory is parsed first, then every block of block_lines lines is split into the line prefix
+        (DOC, calibration and band list bytes) and the data. The memory used is bounded by the block size.
+        Unlike aget, the request is neither retried nor sent to the mirrors of the client (see _iter_server_).
+        Positive lmag/emag are applied to every block, the directory then describes the blown up image.
+
+            async for block in client.aget_stream(group='RTGOESR', descriptor='FD', position=0, band=2, ...):
+                process(block.start_line, block.data)
+
+        The args are the same as in aget
+        :param block_lines: int, number of (unmagnified) image lines per block
+        :return: async iterator of AreaLineBlock(directory, start_line, prefix, data) where data is
+                a numpy array of shape (bands, lines, elements) and prefix an uint8 array of shape (lines, prefix size) or None
+        """
+        assert block_lines > 0, f'Invalid block_lines {block_lines}'
+        req_text, nlines, nelems = await self._prepare_aget_(
+            group=group, descriptor=descriptor, position=position,
+            coord_type=coord_type, coord_pos=coord_pos, coord_start_dim1=coord_start_dim1, coord_start_dim2=coord_start_dim2,
+            nlines=nlines, nelems=nelems,
+            day=day, stime=stime, etime=etime, band=band,
+            unit=unit, spac=spac, cal=cal,
+            lmag=lmag, emag=emag, doc=doc, aux=aux
+        )
+        lmagi, emagi = max(int(lmag), 1), max(int(emag), 1)
+        chunks = self._iter_server_(req_type='aget', req_text=req_text, timeout=self.aget_timeout)
+        pending = bytearray()
+
+        async def fill(nbytes):
+            # read until pending holds at least nbytes, False if the response ended before
+            while len(pending) < nbytes:
+                try:
+                    pending.extend(await chunks.__anext__())
+                except StopAsyncIteration:
+                    return False
+            return True
+
+        try:
+            # 4 bytes size + 256 bytes AREA directory
+            if not await fill(4 + AD_DIRSIZE) or int.from_bytes(pending[:4], 'big') == 0:
+                await fill(96)
+                msg = ''.join([e for e in bytes(pending[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
+                raise Exception(msg)  # should still be 96 bytes with the error
+            words = struct.unpack('>64i', pending[4:4 + AD_DIRSIZE])
+            directory = area_directory(dir_bytes=bytes(pending[4:4 + AD_DIRSIZE]))
+            if lmagi > 1 or emagi > 1:
+                # the blocks are blown up, the directory describes the blown up image like the one aget returns
+                directory, _, _ = self._magnify_directory_(directory=directory, lmag=lmagi, emag=emagi, words=words)
+            lines, elements, element_size, nbands = words[8], words[9], words[10], words[13]
+            prefix_size, data_offset = words[14], words[33]
+            line_size = prefix_size + elements * nbands * element_size
+            # one record per line, the bands are interleaved by element
+            line_dtype = np.dtype([
+                ('prefix', 'u1', (prefix_size, )),
+                ('data', AREA_DATA_DTYPES[element_size], (elements, nbands))
+            ])
+            # skip the navigation and calibration blocks
+            await fill(4 + data_offset)
+            del pending[:4 + data_offset]
+
+            line = 0
+            while line < lines:
+                n = min(block_lines, lines - line)
+                if not await fill(n * line_size):
+                    n = len(pending) // line_size
+                    if n == 0:
+                        raise TruncatedResponseError(f'The aget response from {self.host} ended after {line} of {lines} lines')
+                block = np.frombuffer(pending[:n * line_size], dtype=line_dtype)
+                del pending[:n * line_size]
+                prefix = block['prefix'] if prefix_size > 0 else None
+                data = block['data'].transpose(2, 0, 1)
+                if lmagi > 1 or emagi > 1:
+                    data = util.magnify(input_array=data, dim1_fact=lmagi, dim2_fact=emagi)
+                yield AreaLineBlock(directory=directory, start_line=line * lmagi, prefix=prefix, data=data)
+                line += n
+        finally:
+            await chunks.aclose()
+
+    async def _prepare_aget_(self,
+                             group=None, descriptor=None, position=None,  #dataset args
+                             coord_type='A', coord_pos='U', coord_start_dim1=None, coord_start_dim2=None,  #coord args
+                             nlines=None, nelems=None,   #image props
+                             day=None, stime=None, etime=None,
+                             band=None, unit=None, spac='X', cal='X',
+                             lmag=1, emag=1, doc='YES', aux='YES',
+                             ):
+        """
+        Check the aget args, complete the missing ones (issuing an adir request if the image size is not known)
+        and compose the request text. The args are the same as in aget
+        :return: tuple (request text, nlines, nelems)
+        """
         #some of the args will be handled here while others in _compose_aget_req_text_.
 
         # sanity check
         assert group is not None, f'group  can not be {group}'
         assert descriptor is not None, f'descriptor can not be {descriptor}'
         assert position is not None, f'position can not be {position}'
-        assert group in self.group_names, f'Invalid group {group}. Valid groups on {self.host} are {self.group_names}'
-        valid_descr = tuple([e[0] for e in self._extract_descriptors_(group_name=group)])
-        assert descriptor in valid_descr, f'Invalid descpritor {descriptor} for group {group}. Valid descriptors are {valid_descr}'
-        del valid_descr
+        self._validate_dataset_(group=group, descriptor=descriptor)
 
         assert coord_type not in ['', None], f' Invalid coord_type {coord_type}'
         assert coord_type in VALID_COORD_TYPES, f'Invalid coord_type {coord_type}. Valid values are {VALID_COORD_TYPES}'
@@ -925,11 +1841,150 @@ class AddeClient():
 
         )
 
+        return req_text, nlines, nelems
 
+    def _magnify_area_(self, area_file=None, lmag=1, emag=1, view=False, words=None):
+        """
+        Blow up an image on the client (the ADDE servers do only blow downs)
+        :param area_file: AreaFile instance returned by the server
+        :param lmag: int, line magnification factor
+        :param emag: int, element magnification factor
+        :param view: bool, return a zero copy broadcast view instead of a materialized array
+        :param words: the 64 ints of the AREA directory of the response, used for the resolution and the origin
+        :return: AreaMosaic with the blown up data and the directory lines/elements and resolutions adjusted
+        """
+        directory, origin, resolution = self._magnify_directory_(
+            directory=area_file.directory, lmag=lmag, emag=emag, words=words
+        )
+        data = area_file.data
+        data = util.magnify(input_array=data.reshape((-1,) + data.shape[-2:]), dim1_fact=lmag, dim2_fact=emag, view=view)
+        return AreaMosaic(
+            directory=directory, nav=getattr(area_file, 'nav', None), data=data,
+            tiles=[area_file.directory], lmag=lmag, emag=emag, origin=origin, resolution=resolution
+        )
 
-        bin_resp = await self._query_server_(req_type='aget', req_text=req_text, timeout=self.aget_timeout,read_in_chunks=False)
+    def _magnify_directory_(self, directory=None, lmag=1, emag=1, words=None):
+        """
+        Describe a blown up image
+        :param directory: area_directory of the image returned by the server
+        :param lmag: int, line magnification factor
+        :param emag: int, element magnification factor
+        :param words: the 64 ints of the AREA directory of the response, used for the resolution and the origin
+        :return: tuple (copy of directory with the lines/elements and resolutions adjusted,
+                image line/element of the upper left pixel, image lines/elements per pixel), the last two are None
+                if words is None
+        """
+        directory = copy.copy(directory)
+        directory.lines = directory.lines * lmag
+        directory.elements = directory.elements * emag
+        origin = resolution = None
+        if words is not None:
+            origin = words[AREA_DIRECTORY_WORDS['line_ul']], words[AREA_DIRECTORY_WORDS['element_ul']]
+            # a pixel of the blown up image spans 1/lmag of the image lines of an area pixel
+            resolution = words[AREA_DIRECTORY_WORDS['line_res']] / lmag, words[AREA_DIRECTORY_WORDS['element_res']] / emag
+            directory.line_res, directory.element_res = resolution
+        return directory, origin, resolution
+
+    async def _run_blocking_(self, func=None, *args):
+        """
+        Run a CPU bound function inside the executor of the client so the event loop stays responsive.
+        Without an executor the function is called directly
+        :param func: callable
+        :param args: positional args for func
+        :return: whatever func returns
+        """
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def aget_tiled(self,
+                         group=None, descriptor=None, position=None,  # dataset args
+                         coord_start_dim1=0, coord_start_dim2=0,  # area coord args
+                         nlines=None, nelems=None,  # image props
+                         day=None, stime=None, etime=None,
+                         band=None, unit=None, spac='X', cal='X',
+                         lmag=1, emag=1, doc='YES', aux='YES',
+                         ntiles=4
+                         ):
+        """
+        Request image data in ntiles line bands over ntiles concurrent connections.
+        The ADDE servers serve every request over its own connection so the throughput of one stream is capped
+        by the server. Splitting the image into line bands (AU coordinates) and requesting them concurrently works around that.
+        The image is first located with an adir request and the bands are pinned to its nominal time so
+        all of them come from the same image even when position is relative.
+        Every band is copied into one preallocated array as soon as it arrives.
+
+        :param coord_start_dim1: int, area line of the upper left corner (default 0)
+        :param coord_start_dim2: int, area element of the upper left corner (default 0)
+        :param nlines: int, number of image lines, if None the whole image is requested
+        :param nelems: int, number of image elements, if None the whole image is requested
+        :param ntiles: int, number of line bands/concurrent requests
+        all the other args are the same as in aget
+        :return: an AreaMosaic instance
+        """
+        assert ntiles > 0, f'Invalid ntiles {ntiles}'
+        adirs = await self.adir(
+            group=group, descriptor=descriptor, position=position, band=band,
+            day=day, stime=stime, etime=etime, aux='YES'  # overwrite aux
+        )
+        adir = sorted(adirs, key=lambda d: d.lines * d.elements)[0]
+        if nlines is None or nelems is None:
+            nlines = adir.lines - coord_start_dim1
+            nelems = adir.elements - coord_start_dim2
+        # pin the time so all bands come from the same image
+        sts = adir.start_time.time()
+        day = adir.start_time.date()
+        stime = etime = str(sts)
+
+        # the bands have to start on a multiple of the blowdown factor
+        lstep = abs(int(lmag)) if int(lmag) < 0 else 1
+        # positive mags are applied by the client to every band
+        lfact = int(lmag) if int(lmag) > 1 else 1
+        nlines = nlines - nlines % lstep
+        band_lines = max(lstep, (nlines // ntiles) - (nlines // ntiles) % lstep)
+        starts = list(range(0, nlines, band_lines))
+
+        async def fetch(i, start):
+            area_file = await self.aget(
+                group=group, descriptor=descriptor, position=position,
+                coord_type='A', coord_pos='U', coord_start_dim1=coord_start_dim1 + start, coord_start_dim2=coord_start_dim2,
+                nlines=min(band_lines, nlines - start) // lstep, nelems=nelems,  # counted after the blowdown
+                day=day, stime=stime, etime=etime, band=band, unit=unit, spac=spac, cal=cal,
+                lmag=lmag, emag=emag, doc=doc, aux=aux
+            )
+            return i, area_file
+
+        tasks = [asyncio.ensure_future(fetch(i, start)) for i, start in enumerate(starts)]
+        mosaic = None
+        tiles = [None] * len(tasks)
+        try:
+            for next_tile in asyncio.as_completed(tasks):
+                i, area_file = await next_tile
+                tile_data = area_file.data
+                tile_data = tile_data.reshape((-1,) + tile_data.shape[-2:])
+                if mosaic is None:
+                    out_lines = nlines // lstep * lfact
+                    mosaic = AreaMosaic(
+                        data=np.empty((tile_data.shape[0], out_lines, tile_data.shape[2]), dtype=tile_data.dtype),
+                        tiles=tiles, lmag=lfact, emag=max(int(emag), 1)
+                    )
+                out_start = starts[i] // lstep * lfact
+                out_end = min(out_start + tile_data.shape[1], mosaic.data.shape[1])
+                mosaic.data[:, out_start:out_end, :] = tile_data[:, :out_end - out_start, :]
+                tiles[i] = area_file.directory
+                if i == 0:
+                    mosaic.nav = getattr(area_file, 'nav', None)
+                del area_file, tile_data
+        except Exception:
+            for t in tasks:
+                t.cancel()
+            raise
+        if len({t.nominal_time for t in tiles}) > 1:
+            raise Exception(f'The line bands of {group}/{descriptor} were served from different images')
 
-        return self._parse_aget_response_(bin_response=bin_resp)
+        mosaic.directory = copy.copy(tiles[0])
+        mosaic.directory.lines = mosaic.data.shape[1]
+        return mosaic
 
 
 
@@ -0,0 +1,103 @@
+import os
+import time
+import random
+import socket
+import asyncio
+import logging
+import collections
+import numpy as np
+
+_, n = os.path.split(os.path.abspath(__file__))
+
+logger = logging.getLogger(n)
+
+
+class TruncatedResponseError(ConnectionError):
+    """
+    The server closed the connection before the whole response was sent, the request can be retried
+    """
+
+
+# the errors after which a request is retried or sent to another mirror: the connection was refused, reset or cut,
+# timed out or the name of the host could not be resolved. Other OSErrors (no space left, too many open files)
+# are local and would fail again
+RETRIABLE_ERRORS = (TruncatedResponseError, ConnectionError, TimeoutError, asyncio.TimeoutError, socket.gaierror)
+
+
+def backoff_delay(attempt=None, base=.5, max_delay=30):
+    """
+    Exponential backoff with full jitter, the delay is drawn uniformly between 0 and base * 2 ** attempt
+    so the clients that failed together do not retry together
+    :param attempt: int, 0 based number of the failed attempt
+    :param base: number, seconds
+    :param max_delay: number, upper bound of the delay in seconds
+    :return: float, seconds to sleep before the next attempt
+    """
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
+
+class LatencyTracker():
+    """
+    Recent latencies of the requests sent to every host, by request type. Used to rank the mirrors of a dataset
+    and to decide when a request is slow enough to be hedged. A host that failed recently is ranked after the others.
+    """
+
+    def __init__(self, window=100, failure_ttl=300):
+        """
+        :param window: int, number of latencies kept per host and request type
+        :param failure_ttl: number, seconds during which a failed host is ranked last
+        """
+        self.window = window
+        self.failure_ttl = failure_ttl
+        self._latencies_ = dict()
+        self._failures_ = dict()
+
+    def record(self, host=None, req_type=None, latency=None):
+        key = host.lower(), req_type
+        if key not in self._latencies_:
+            self._latencies_[key] = collections.deque(maxlen=self.window)
+        self._latencies_[key].append(latency)
+
+    def failure(self, host=None):
+        self._failures_[host.lower()] = time.monotonic()
+
+    def failed_recently(self, host=None):
+        failed_at = self._failures_.get(host.lower())
+        return failed_at is not None and time.monotonic() - failed_at < self.failure_ttl
+
+    def percentile(self, host=None, req_type=None, q=None, min_samples=10):
+        """
+        :param q: number, percentile between 0 and 100
+        :param min_samples: int, min number of latencies needed to compute the percentile
+        :return: float, seconds or None if there are not enough samples
+        """
+        latencies = self._latencies_.get((host.lower(), req_type))
+        if latencies is None or len(latencies) < min_samples:
+            return
+        return float(np.percentile(latencies, q))
+
+    def rank(self, hosts=None, req_type=None):
+        """
+        Order the hosts by recent failure and median latency. The hosts without measurements keep
+        their relative order and come after the measured ones
+        :param hosts: iterable of str
+        :return: list of str
+        """
+        def key(item):
+            position, host = item
+            median = self.percentile(host=host, req_type=req_type, q=50, min_samples=1)
+            return self.failed_recently(host), median is None, median or 0., position
+        return [h for _, h in sorted(enumerate(hosts), key=key)]
+
+    def stats(self):
+        """
+        :return: dict (host, req_type) -> number of samples and median/95th percentile latency
+        """
+        return {
+            k: dict(samples=len(v), p50=float(np.percentile(v, 50)), p95=float(np.percentile(v, 95)))
+            for k, v in self._latencies_.items() if v
+        }
+
+
+# the latencies shared by all clients
+HOST_LATENCIES = LatencyTracker()
@@ -0,0 +1,410 @@
+import os
+import time
+import asyncio
+import logging
+import weakref
+import collections
+
+_, n = os.path.split(os.path.abspath(__file__))
+
+logger = logging.getLogger(n)
+
+# priority classes, the lower the value the higher the priority
+PRIORITY_REALTIME = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BACKFILL = 2
+
+
+class HostStats():
+    """
+    Counters of the requests a scheduler has served for one host
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.queued = 0
+        self.requests = 0
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+        self.transfer_time = 0.
+
+    def add(self, other=None):
+        self.active += other.active
+        self.queued += other.queued
+        self.requests += other.requests
+        self.wait_time += other.wait_time
+        self.max_wait_time = max(self.max_wait_time, other.max_wait_time)
+        self.transfer_time += other.transfer_time
+
+    def as_dict(self):
+        return dict(
+            active=self.active, queued=self.queued, requests=self.requests,
+            wait_time=self.wait_time, max_wait_time=self.max_wait_time, transfer_time=self.transfer_time,
+            avg_wait_time=self.wait_time / self.requests if self.requests else 0.,
+            avg_transfer_time=self.transfer_time / self.requests if self.requests else 0.,
+        )
+
+
+class HostWindow():
+    """
+    AIMD state of one host
+    """
+
+    def __init__(self, window=None, now=None):
+        self.window = window
+        self.throughput = 0.  # bytes/s measured over the last interval
+        self.previous = 0.  # throughput of the interval before the last window change
+        self.interval_start = now
+        self.interval_bytes = 0
+        self.saturated = False
+        self.errors = 0
+        self.last_decrease = None
+
+    def as_dict(self):
+        return dict(window=self.window, throughput=self.throughput, errors=self.errors)
+
+
+class AdaptiveConcurrency():
+    """
+    Additive increase/multiplicative decrease (AIMD) of the number of concurrent connections per host.
+    The aggregate throughput to a host is measured over intervals. At the end of an interval in which all the
+    connections were in use the window is increased additively as long as the throughput keeps improving.
+    Refused connections, timeouts and resets, as well as a collapse of the throughput, cut the window multiplicatively.
+    """
+
+    # the errors that signal an overloaded server or network
+    congestion_errors = (ConnectionError, OSError, asyncio.TimeoutError)
+
+    def __init__(self, initial_window=2, min_window=1, max_window=32, interval=2.,
+                 increase=1, decrease=.5, min_gain=.05, collapse=.5):
+        """
+        :param initial_window: int, number of concurrent connections to a new host
+        :param min_window: int
+        :param max_window: int
+        :param interval: number, seconds over which the throughput is measured
+        :param increase: int, additive increase of the window
+        :param decrease: float, multiplicative decrease factor of the window
+        :param min_gain: float, relative throughput gain needed to keep increasing the window
+        :param collapse: float, the window is decreased when the throughput falls under this fraction of the previous one
+        """
+        assert 0 < min_window <= initial_window <= max_window, f'Invalid windows {min_window} {initial_window} {max_window}'
+        assert 0 < decrease < 1, f'Invalid decrease {decrease}'
+        self.initial_window = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.min_gain = min_gain
+        self.collapse = collapse
+        self._hosts_ = dict()
+
+    def _host_(self, host=None):
+        if host not in self._hosts_:
+            self._hosts_[host] = HostWindow(window=self.initial_window, now=time.perf_counter())
+        return self._hosts_[host]
+
+    def window(self, host=None):
+        """
+        :return: int, the current number of concurrent connections allowed to the host
+        """
+        return self._host_(host.lower()).window
+
+    def throughput(self, host=None):
+        """
+        :return: float, bytes/s to the host measured over the last interval
+        """
+        return self._host_(host.lower()).throughput
+
+    def _decrease_(self, host=None, state=None, now=None, reason=None):
+        # one decrease per interval so a burst of errors does not collapse the window to the minimum
+        if state.last_decrease is not None and now - state.last_decrease < self.interval:
+            return
+        window = max(self.min_window, int(state.window * self.decrease))
+        logger.debug(f'Decreasing the window of {host} from {state.window} to {window} ({reason})')
+        state.window = window
+        state.last_decrease = now
+        state.previous = 0.
+
+    def observe(self, host=None, nbytes=0, error=None, saturated=False):
+        """
+        Account a finished request
+        :param host: str
+        :param nbytes: int, number of bytes transferred
+        :param error: exception raised by the request or None
+        :param saturated: bool, True if all the connections allowed to the host were in use
+        """
+        host = host.lower()
+        state = self._host_(host)
+        now = time.perf_counter()
+        if error is not None and isinstance(error, self.congestion_errors):
+            state.errors += 1
+            self._decrease_(host=host, state=state, now=now, reason=error.__class__.__name__)
+            return
+        state.interval_bytes += nbytes or 0
+        state.saturated = state.saturated or saturated
+        elapsed = now - state.interval_start
+        if elapsed < self.interval:
+            return
+        state.throughput = state.interval_bytes / elapsed
+        if state.previous and state.throughput < state.previous * self.collapse:
+            self._decrease_(host=host, state=state, now=now, reason=f'throughput collapsed to {state.throughput:.0f} B/s')
+        elif state.saturated and state.window < self.max_window and state.throughput >= state.previous * (1 + self.min_gain):
+            state.window = min(self.max_window, state.window + self.increase)
+            state.previous = state.throughput
+            logger.debug(f'Increasing the window of {host} to {state.window} at {state.throughput:.0f} B/s')
+        state.interval_start = now
+        state.interval_bytes = 0
+        state.saturated = False
+
+    def stats(self):
+        """
+        :return: dict host -> window, throughput and number of errors
+        """
+        return {h: s.as_dict() for h, s in self._hosts_.items()}
+
+
+class Slot():
+    """
+    Permission to open one connection to a host. Used as an async context manager:
+
+        async with scheduler.slot(host=host, priority=PRIORITY_REALTIME) as slot:
+            ...
+        slot.wait_time, slot.transfer_time
+    """
+
+    def __init__(self, scheduler=None, host=None, priority=PRIORITY_DEFAULT, tenant=None):
+        self.scheduler = scheduler
+        self.host = host.lower()
+        self.priority = priority
+        self.tenant = tenant
+        self.future = None
+        # LoopState of the event loop the slot was acquired in
+        self.state = None
+        self.enqueued_at = self.granted_at = self.released_at = None
+        # number of bytes transferred, set by the client, used by the adaptive concurrency
+        self.nbytes = 0
+
+    @property
+    def wait_time(self):
+        """
+        seconds spent in the queue
+        """
+        if self.granted_at is None:
+            return
+        return self.granted_at - self.enqueued_at
+
+    @property
+    def transfer_time(self):
+        """
+        seconds the connection slot was held
+        """
+        if self.released_at is None:
+            return
+        return self.released_at - self.granted_at
+
+    async def __aenter__(self):
+        await self.scheduler._acquire_(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.scheduler._release_(self, error=exc_val)
+
+
+class LoopState():
+    """
+    The connections and the waiters of a scheduler in one event loop, the futures of the waiters belong to the loop
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.stats = collections.defaultdict(HostStats)
+        # priority -> tenant -> deque of waiting slots
+        self.waiters = collections.defaultdict(collections.OrderedDict)
+
+
+class ConnectionScheduler():
+    """
+    Scheduler shared by the clients that limits the number of concurrent connections per host and in total.
+    The requests waiting for a connection are served by priority class (real time before backfill) and,
+    inside a priority class, round robin between the tenants so one tenant can not starve the others.
+    The time spent waiting in the queue is reported separately from the time the connection was held.
+    The limits apply to every event loop separately, the state of a loop goes away with the loop so
+    successive asyncio.run calls do not see the waiters or the connections left by the previous ones.
+    """
+
+    def __init__(self, max_per_host=8, max_total=128, host_limits=None, adaptive=None):
+        """
+        :param max_per_host: int, default max number of concurrent connections to one host
+        :param max_total: int, max number of concurrent connections to all hosts
+        :param host_limits: dict, host -> max number of concurrent connections, overrides max_per_host
+        :param adaptive: AdaptiveConcurrency instance, if supplied it sets the per host limits instead of max_per_host
+        """
+        assert max_per_host > 0, f'Invalid max_per_host {max_per_host}'
+        assert max_total > 0, f'Invalid max_total {max_total}'
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.host_limits = {h.lower(): v for h, v in (host_limits or {}).items()}
+        self.adaptive = adaptive
+        # event loop -> LoopState
+        self._states_ = weakref.WeakKeyDictionary()
+
+    def _state_(self):
+        loop = asyncio.get_event_loop()
+        state = self._states_.get(loop)
+        if state is None:
+            state = self._states_[loop] = LoopState()
+        return state
+
+    @property
+    def active(self):
+        """
+        number of connections in use in all the event loops
+        """
+        return sum(state.active for state in list(self._states_.values()))
+
+    def host_limit(self, host=None):
+        host = host.lower()
+        if host in self.host_limits:
+            return self.host_limits[host]
+        if self.adaptive is not None:
+            return self.adaptive.window(host)
+        return self.max_per_host
+
+    def set_adaptive(self, adaptive=None):
+        """
+        Enable (AdaptiveConcurrency instance) or disable (None) the adaptive per host limits
+        """
+        self.adaptive = adaptive
+        self._dispatch_all_()
+
+    def set_host_limit(self, host=None, limit=None):
+        """
+        Change the max number of concurrent connections to a host
+        """
+        assert limit is None or limit > 0, f'Invalid limit {limit}'
+        if limit is None:
+            self.host_limits.pop(host.lower(), None)
+        else:
+            self.host_limits[host.lower()] = limit
+        self._dispatch_all_()
+
+    def slot(self, host=None, priority=PRIORITY_DEFAULT, tenant=None):
+        """
+        :param host: str, the host the connection will be opened to
+        :param priority: int, priority class, PRIORITY_REALTIME, PRIORITY_DEFAULT or PRIORITY_BACKFILL
+        :param tenant: hashable, identifies the consumer, the tenants are served round robin
+        :return: Slot, an async context manager
+        """
+        return Slot(scheduler=self, host=host, priority=priority, tenant=tenant)
+
+    def _has_capacity_(self, state=None, host=None):
+        return state.active < self.max_total and state.stats[host].active < self.host_limit(host)
+
+    def _grant_(self, state=None, slot=None):
+        stats = state.stats[slot.host]
+        stats.active += 1
+        stats.requests += 1
+        state.active += 1
+        slot.granted_at = time.perf_counter()
+        wait_time = slot.wait_time
+        stats.wait_time += wait_time
+        stats.max_wait_time = max(stats.max_wait_time, wait_time)
+
+    async def _acquire_(self, slot=None):
+        slot.enqueued_at = time.perf_counter()
+        slot.state = state = self._state_()
+        if self._has_capacity_(state, slot.host) and not state.waiters:
+            self._grant_(state, slot)
+            return
+        slot.future = asyncio.get_event_loop().create_future()
+        state.waiters[slot.priority].setdefault(slot.tenant, collections.deque()).append(slot)
+        state.stats[slot.host].queued += 1
+        try:
+            self._dispatch_(state)
+            await slot.future
+        except asyncio.CancelledError:
+            if slot.granted_at is not None:
+                # the slot was granted right before the cancellation
+                self._release_(slot)
+            else:
+                self._dequeue_(slot)
+            raise
+
+    def _dequeue_(self, slot=None):
+        state = slot.state
+        tenants = state.waiters.get(slot.priority)
+        if not tenants or slot.tenant not in tenants:
+            return
+        queue = tenants[slot.tenant]
+        try:
+            queue.remove(slot)
+            state.stats[slot.host].queued -= 1
+        except ValueError:
+            return
+        if not queue:
+            del tenants[slot.tenant]
+        if not tenants:
+            del state.waiters[slot.priority]
+
+    def _dispatch_all_(self):
+        for state in list(self._states_.values()):
+            self._dispatch_(state)
+
+    def _dispatch_(self, state=None):
+        """
+        Grant the slots to the waiters of an event loop by priority and round robin between the tenants
+        """
+        granted = True
+        while granted and state.active < self.max_total:
+            granted = False
+            for priority in sorted(state.waiters):
+                tenants = state.waiters.get(priority, {})
+                for tenant in list(tenants):
+                    queue = tenants[tenant]
+                    # the waiters cancelled before they could leave the queue
+                    for stale in [s for s in queue if s.future.done()]:
+                        self._dequeue_(stale)
+                    slot = next((s for s in queue if self._has_capacity_(state, s.host)), None)
+                    if slot is None:
+                        continue
+                    self._dequeue_(slot)
+                    self._grant_(state, slot)
+                    slot.future.set_result(None)
+                    # round robin, the tenant goes to the end of the line
+                    if tenant in tenants:
+                        tenants.move_to_end(tenant)
+                    granted = True
+                    break
+                if granted:
+                    break
+
+    def _release_(self, slot=None, error=None):
+        slot.released_at = time.perf_counter()
+        state = slot.state
+        stats = state.stats[slot.host]
+        if self.adaptive is not None:
+            saturated = stats.active >= self.host_limit(slot.host) or stats.queued > 0
+            self.adaptive.observe(host=slot.host, nbytes=slot.nbytes, error=error, saturated=saturated)
+        stats.active -= 1
+        stats.transfer_time += slot.transfer_time
+        state.active -= 1
+        self._dispatch_(state)
+
+    def stats(self, host=None):
+        """
+        :param host: str, if None the stats of all hosts are returned
+        :return: dict with the number of active/queued/served requests and the queue wait and transfer times,
+                summed over the event loops
+        """
+        totals = collections.defaultdict(HostStats)
+        for state in list(self._states_.values()):
+            for h, stats in state.stats.items():
+                totals[h].add(stats)
+        if host is not None:
+            return totals[host.lower()].as_dict()
+        return {h: s.as_dict() for h, s in totals.items()}
+
+
+# the scheduler shared by all clients
+CONNECTION_SCHEDULER = ConnectionScheduler()
@@ -0,0 +1,222 @@
+import os
+import logging
+import numpy as np
+from pyarea.directory import area_directory
+
+_, n = os.path.split(os.path.abspath(__file__))
+
+logger = logging.getLogger(n)
+
+AD_DIRSIZE = 64 * 4
+AD_COMMENT_SIZE = 80
+
+# 0 based indices of the AREA directory words, see the McIDAS AREA file format
+AREA_DIRECTORY_WORDS = dict(
+    sensor=2,
+    nominal_date=3, nominal_hms=4,
+    line_ul=5, element_ul=6,
+    lines=8, elements=9, element_size=10,
+    line_res=11, element_res=12,
+    nbands=13, prefix_size=14, project=15,
+    band_map=18,
+    source_type=51, calibration_type=52,
+    start_date=45, start_hms=46, start_scan=47,
+    comment_count=63,
+)
+
+
+def mcidas_time(yyyddd=None, hhmmss=None):
+    """
+    Vectorized conversion of McIDAS dates (yyyddd, year-1900) and times (hhmmss) into numpy datetime64
+    :param yyyddd: int array
+    :param hhmmss: int array
+    :return: datetime64[s] array
+    """
+    year = 1900 + yyyddd // 1000
+    doy = yyyddd % 1000
+    seconds = (hhmmss // 10000) * 3600 + (hhmmss // 100 % 100) * 60 + hhmmss % 100
+    return ((year - 1970).astype('datetime64[Y]').astype('datetime64[s]')
+            + ((doy - 1) * 86400 + seconds).astype('timedelta64[s]'))
+
+
+def record_offsets(words=None, size=None):
+    """
+    Find the byte offsets of the records of an adir response. Every record consists of
+    4-byte value with the size of the rest of the record (260 + 80 * number of comments),
+    4-byte area number, 256-byte directory and the comments.
+    When all records have the same size the offsets are computed and checked in a vectorized manner,
+    otherwise they are found by hopping from record to record.
+    :param words: big endian int32 view over the response
+    :param size: int, size of the response in bytes
+    :return: int64 array of byte offsets
+    """
+    first = int(words[0])
+    if first <= 0:
+        return np.empty(0, dtype=np.int64)
+    step = first + 4
+    nrecords = size // step
+    if nrecords > 0:
+        offsets = np.arange(nrecords, dtype=np.int64) * step
+        if np.all(words[offsets // 4] == first) and (nrecords * step >= size or int(words[nrecords * step // 4]) <= 0):
+            return offsets
+    offsets = []
+    offset = 0
+    while offset + 4 + AD_DIRSIZE <= size:
+        nbytes = int(words[offset // 4])
+        if nbytes <= 0:
+            break
+        offsets.append(offset)
+        offset += 4 + nbytes
+    return np.array(offsets, dtype=np.int64)
+
+
+class AreaDirectoryTable():
+    """
+    Columnar view of the AREA directories returned by an adir request.
+    The directories are read from the response through a (ndirs, 64) big endian int32 view so parsing
+    thousands of directories is a handful of numpy operations. The columns (nominal_time, start_time, band,
+    lines, elements, resolutions, etc.) are numpy arrays that can be used to filter and sort the table.
+    The area_directory objects are created only for the rows that are accessed.
+    """
+
+    def __init__(self, bin_response=None, offsets=None, words=None, annotate=None):
+        """
+        :param bin_response: bytes like, the decompressed adir response
+        :param offsets: int array, byte offsets of the records to include
+        :param words: (n, 64) int array, the directory words of the records
+        :param annotate: callable applied to every area_directory created by the table
+        """
+        self.bin_response = bin_response
+        self.offsets = offsets
+        self.words = words
+        self.annotate = annotate
+        self._columns_ = dict()
+        self._directories_ = dict()
+
+    @classmethod
+    def from_response(cls, bin_response=None, annotate=None):
+        """
+        Create a table from a decompressed adir response
+        :param bin_response: bytes like
+        :param annotate: callable applied to every area_directory created by the table
+        :return: AreaDirectoryTable
+        """
+        size = len(bin_response) - len(bin_response) % 4
+        words = np.frombuffer(bin_response, dtype='>i4', count=size // 4)
+        if size < 8 or words[0] == 0:  # something went wrong
+            msg = ''.join([e for e in bytes(bin_response[12:12 + 72]).decode('utf-8') if e.isalpha() or e == ' '])
+            raise Exception(msg)  # should still be 96 bytes with the error
+        offsets = record_offsets(words=words, size=size)
+        # the directory starts after the size and the area number
+        dir_index = (offsets // 4 + 2)[:, None] + np.arange(64)
+        return cls(bin_response=bin_response, offsets=offsets, words=words[dir_index].astype(np.int32), annotate=annotate)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self)} directories)'
+
+    def column(self, name=None):
+        """
+        :param name: str, a key of AREA_DIRECTORY_WORDS or one of area_number, nominal_time, start_time, band
+        :return: numpy array
+        """
+        if name not in self._columns_:
+            if name in AREA_DIRECTORY_WORDS:
+                col = self.words[:, AREA_DIRECTORY_WORDS[name]]
+            elif name == 'area_number':
+                col = np.array([int.from_bytes(self.bin_response[o + 4:o + 8], 'big') for o in self.offsets], dtype=np.int32)
+            elif name == 'nominal_time':
+                col = mcidas_time(self.column('nominal_date').astype(np.int64), self.column('nominal_hms').astype(np.int64))
+            elif name == 'start_time':
+                start_date = self.column('start_date').astype(np.int64)
+                start_hms = self.column('start_hms').astype(np.int64)
+                # older directories do not hold the actual start time
+                missing = start_date == 0
+                start_date[missing] = self.column('nominal_date')[missing]
+                start_hms[missing] = self.column('nominal_hms')[missing]
+                col = mcidas_time(start_date, start_hms)
+            elif name == 'band':
+                # first band of the band map (bands 1-32), 0 if the map is empty
+                band_map = self.column('band_map').astype(np.int64) & 0xFFFFFFFF
+                lowest = band_map & -band_map
+                col = np.where(band_map == 0, 0, np.log2(np.maximum(lowest, 1)).astype(np.int32) + 1)
+            else:
+                raise KeyError(f'Invalid column {name}')
+            self._columns_[name] = col
+        return self._columns_[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in ('bin_response', 'offsets', 'words', 'annotate'):
+            raise AttributeError(name)
+        try:
+            return self.column(name)
+        except KeyError:
+            raise AttributeError(f'{self.__class__.__name__} has no attribute or column {name}')
+
+    def take(self, rows=None):
+        """
+        Create a new table holding the selected rows
+        :param rows: int array of row indices or bool mask
+        :return: AreaDirectoryTable
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        table = AreaDirectoryTable(bin_response=self.bin_response, offsets=self.offsets[rows], words=self.words[rows], annotate=self.annotate)
+        for name, col in self._columns_.items():
+            table._columns_[name] = col[rows]
+        return table
+
+    def filter(self, mask=None):
+        """
+        :param mask: bool array, ex table.filter(table.lines > 1000)
+        :return: AreaDirectoryTable with the rows where mask is True
+        """
+        return self.take(mask)
+
+    def sort(self, by='nominal_time', reverse=False):
+        """
+        :param by: str, column name
+        :param reverse: bool
+        :return: AreaDirectoryTable sorted by the column (stable)
+        """
+        rows = np.argsort(self.column(by), kind='stable')
+        if reverse:
+            rows = rows[::-1]
+        return self.take(rows)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self))[item])
+        if isinstance(item, str):
+            return self.column(item)
+        if not isinstance(item, (int, np.integer)):
+            return self.take(item)
+        row = int(item)
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f'Row {item} is out of range')
+        if row not in self._directories_:
+            start = int(self.offsets[row]) + 8
+            end = start + AD_DIRSIZE
+            ad = area_directory(dir_bytes=bytes(self.bin_response[start:end]))
+            if ad.comment_count > 0:
+                csize = ad.comment_count * AD_COMMENT_SIZE
+                ad.add_comments(comment_bytes=bytes(self.bin_response[end:end + csize]))
+            if self.annotate is not None:
+                self.annotate(ad)
+            self._directories_[row] = ad
+        return self._directories_[row]
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def to_list(self):
+        """
+        :return: list of area_directory objects
+        """
+        return list(self)
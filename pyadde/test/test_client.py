@@ -0,0 +1,835 @@
+"""
+Tests of AddeClient and of the parts it is made of.
+
+    python -m pytest -q pyadde/test/test_client.py
+"""
+import os
+import gzip
+import time
+import zlib
+import struct
+import types
+import asyncio
+import datetime
+import threading
+import concurrent.futures
+import numpy as np
+import pytest
+from pyadde import util
+from pyadde.client import AddeClient, GzipStreamInflater, AddeBufferedProtocol, ResponseBuffer, BufferPool
+from pyadde.cache import ResponseCache, INFLIGHT_REQUESTS
+from pyadde.catalog import CatalogRegistry
+from pyadde.table import AreaDirectoryTable
+from pyadde.failover import TruncatedResponseError, LatencyTracker
+from pyadde.scheduler import ConnectionScheduler, AdaptiveConcurrency, PRIORITY_REALTIME, PRIORITY_DEFAULT, PRIORITY_BACKFILL
+
+
+def inflate(compressed=None, chunk_size=None):
+    inflater = GzipStreamInflater()
+    chunks = [inflater.inflate(compressed[i:i + chunk_size]) for i in range(0, len(compressed), chunk_size)]
+    return b''.join(chunks) + inflater.flush()
+
+
+@pytest.mark.parametrize('chunk_size', (1, 7, 1024, 2**20))
+def test_inflate_chunks(chunk_size):
+    data = np.arange(50000, dtype='>i4').tobytes()
+    assert inflate(gzip.compress(data), chunk_size) == data
+    # concatenated members with zero padding in between are read like gzip.GzipFile does
+    members = gzip.compress(data[:1000]) + bytes(16) + gzip.compress(data[1000:])
+    assert inflate(members, chunk_size) == data
+
+
+def test_inflate_truncated():
+    compressed = gzip.compress(bytes(range(256)) * 100)
+    inflater = GzipStreamInflater()
+    inflater.inflate(compressed[:len(compressed) // 2])
+    with pytest.raises(TruncatedResponseError):
+        inflater.flush()
+    with pytest.raises(TruncatedResponseError):
+        GzipStreamInflater().flush()
+
+
+class FakeTransport():
+
+    def __init__(self):
+        self.paused = self.resumed = 0
+        self.aborted = False
+
+    def pause_reading(self):
+        self.paused += 1
+
+    def resume_reading(self):
+        self.resumed += 1
+
+    def abort(self):
+        self.aborted = True
+
+
+async def receive(protocol=None, data=None, chunk_size=None):
+    """
+    Feed data to an AddeBufferedProtocol the way the transport does and return the response
+    """
+    protocol.connection_made(FakeTransport())
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i:i + chunk_size]
+        buffer = protocol.get_buffer(len(chunk))
+        assert len(buffer) >= len(chunk)
+        buffer[:len(chunk)] = chunk
+        protocol.buffer_updated(len(chunk))
+    protocol.connection_lost(None)
+    return await protocol.done
+
+
+@pytest.mark.parametrize('compressed', (True, False))
+def test_buffered_protocol(compressed):
+    async def main():
+        data = np.arange(100000, dtype='>i4').tobytes()
+        protocol = AddeBufferedProtocol(compressed=compressed, size_hint=1000)
+        response = await receive(protocol, gzip.compress(data) if compressed else data, 3000)
+        assert response.readonly and response.tobytes() == data
+        if compressed:  # a compressed response cut short does not inflate
+            protocol = AddeBufferedProtocol(compressed=True)
+            with pytest.raises(TruncatedResponseError):
+                await receive(protocol, gzip.compress(data)[:5000], 3000)
+    asyncio.run(main())
+
+
+def test_buffer_pool():
+    pool = BufferPool(max_bytes=2**20, max_buffer_size=2**19)
+    response = ResponseBuffer(size_hint=1000, pool=pool)
+    response.write(b'x' * 5000)
+    view = response.view()
+    buffer = response.buffer
+    response.recycle()
+    assert pool.stats()['buffers'] == 1
+    # the buffer is not handed out while the view over the previous response exists
+    assert pool.acquire(100) is not buffer
+    view.release()
+    assert pool.acquire(100) is buffer
+    assert pool.stats() == dict(buffers=0, size=0, allocated=2, reused=1)
+    # large buffers are not pooled
+    pool.release(bytearray(2**20))
+    assert pool.stats()['buffers'] == 0
+
+
+def pixels(band=None, lines=None, elements=None):
+    """
+    Synthetic image values over the absolute line and element indices
+    """
+    lines, elements = np.asarray(lines), np.asarray(elements)
+    return ((lines[:, None] * 7 + elements[None, :] * 3 + band * 1000) % 32767).astype('>i2')
+
+
+class FakeImage():
+    """
+    Stands in for the adir/aget methods of AddeClient with one image of synthetic values
+    """
+
+    def __init__(self, lines=300, elements=200, bands=(2, 3), delay=0.):
+        self.lines = lines
+        self.elements = elements
+        self.bands = bands
+        self.delay = delay
+        self.start_time = datetime.datetime(2020, 1, 1, 12)
+        self.requests = []
+        self.running = self.max_running = 0
+
+    def directory(self, lines=None, elements=None, start_time=None):
+        start_time = start_time or self.start_time
+        return types.SimpleNamespace(lines=lines or self.lines, elements=elements or self.elements,
+                                     start_time=start_time, nominal_time=start_time, bands=list(self.bands))
+
+    async def adir(self, **kwargs):
+        self.requests.append(('adir', kwargs))
+        return [self.directory()]
+
+    async def aget(self, coord_start_dim1=0, coord_start_dim2=0, nlines=None, nelems=None, band=None, lmag=1, emag=1, **kwargs):
+        self.requests.append(('aget', dict(coord_start_dim1=coord_start_dim1, coord_start_dim2=coord_start_dim2,
+                                           nlines=nlines, nelems=nelems, band=band, lmag=lmag, emag=emag, **kwargs)))
+        bands = self.bands if band in (None, 'ALL') else [band] if isinstance(band, int) else [int(b) for b in band.split()]
+        if not set(bands) <= set(self.bands):
+            raise Exception('The requested band is not available')
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        lstep, estep = max(-lmag, 1), max(-emag, 1)
+        nlines, nelems = nlines or self.lines // lstep, nelems or self.elements // estep
+        lines = range(coord_start_dim1, min(coord_start_dim1 + nlines * lstep, self.lines), lstep)
+        elements = range(coord_start_dim2, min(coord_start_dim2 + nelems * estep, self.elements), estep)
+        data = np.stack([pixels(b, lines, elements) for b in bands])
+        return types.SimpleNamespace(data=data, nav=b'nav', directory=self.directory(lines=len(lines), elements=len(elements)))
+
+    def patch(self, client=None):
+        client.adir, client.aget = self.adir, self.aget
+        return client
+
+
+@pytest.mark.parametrize('lmag', (1, -2))
+def test_aget_tiled(lmag):
+    async def main():
+        image = FakeImage(delay=.01)
+        client = image.patch(AddeClient(host='127.0.0.1'))
+        mosaic = await client.aget_tiled(group='MOCK', descriptor='FD', position=0, band='ALL', coord_start_dim1=10,
+                                         nlines=100, nelems=150, lmag=lmag, ntiles=4)
+        step = max(-lmag, 1)
+        assert mosaic.data.shape == (2, 100 // step, 150)
+        for i, band in enumerate(image.bands):
+            assert np.array_equal(mosaic.data[i], pixels(band, range(10, 110, step), range(150)))
+        agets = [kwargs for service, kwargs in image.requests if service == 'aget']
+        assert len(agets) == len(mosaic.tiles) >= 4 and image.max_running == len(agets)
+        # the bands start on a multiple of the blowdown, do not overlap and are pinned to the time of the image
+        assert all((r['coord_start_dim1'] - 10) % step == 0 and r['stime'] == '12:00:00' for r in agets)
+        assert sum(r['nlines'] for r in agets) == 100 // step
+        assert mosaic.directory.lines == 100 // step and mosaic.nav == b'nav'
+    asyncio.run(main())
+
+
+def test_aget_many():
+    async def main():
+        image = FakeImage(delay=.01)
+        client = image.patch(AddeClient(host='127.0.0.1'))
+        directory = image.directory()
+        directory.group, directory.descriptor = 'MOCK', 'FD'
+        specs = [dict(band=2, nlines=10, nelems=10, coord_start_dim1=i) for i in range(6)] + [dict(band=9, nlines=10, nelems=10), directory]
+        results = [r async for r in client.aget_many(specs, max_concurrency=3, lmag=-2)]
+        assert image.max_running == 3
+        assert sorted(map(id, (spec for spec, _ in results))) == sorted(map(id, specs))
+        for spec, result in results:
+            if spec is directory:  # pinned to the time of the image, the aget args apply to the directories only
+                assert result.data.shape == (2, 150, 200)
+            elif spec['band'] == 9:  # a failure does not stop the batch
+                assert isinstance(result, Exception)
+            else:
+                assert np.array_equal(result.data[0], pixels(2, range(spec['coord_start_dim1'], spec['coord_start_dim1'] + 10), range(10)))
+        assert image.requests[-1][1]['stime'] == '12:00:00'
+        # leaving the batch early cancels the requests in flight
+        batch = client.aget_many(specs[::-1], max_concurrency=3)
+        await batch.__anext__()  # the failure
+        assert image.running > 0
+        await batch.aclose()
+        assert image.running == 0
+    asyncio.run(main())
+
+
+def test_response_cache(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path), max_size=3000, relative_ttl=60, mmap_min_size=1000)
+    request = dict(host='Server', port=112, req_type='aget')
+    absolute, relative = 'MOCK FD 3 AU 0 0 X 10 10', 'MOCK FD 0 AU 0 0 X 10 10'
+    small, large = struct.pack('>2i', 100, 1) + bytes(100), struct.pack('>2i', 1000, 1) + bytes(1000)
+    assert cache.get(req_text=absolute, **request) is None
+    cache.put(req_text=absolute, data=small, **request)
+    cache.put(req_text=relative, data=large, **request)
+    cache.put(req_text='MOCK FD 4', data=bytes(96), **request)  # error responses are not cached
+    # the canonical request ignores the case and the blanks
+    hit = cache.get(host='server', port=112, req_type='AGET', req_text=f' {absolute.lower()}  ')
+    assert isinstance(hit, bytes) and hit == small
+    with cache.get(req_text=relative, **request) as view:  # large responses are memory mapped
+        assert isinstance(view, memoryview) and view == large
+    assert cache.get(req_text='MOCK FD 4', **request) is None
+    assert (cache.hits, cache.misses, len(os.listdir(tmp_path))) == (2, 2, 2)
+    # the responses to relative requests expire, the others are evicted when the cache is full only
+    old = time.time() - 3600
+    for name in os.listdir(tmp_path):
+        os.utime(os.path.join(tmp_path, name), (old, old))
+    assert cache.get(req_text=relative, **request) is None
+    assert cache.get(req_text=absolute, **request) == small
+    for i in range(3):
+        cache.put(req_text=f'MOCK FD {10 + i}', data=large, **request)
+    assert cache.size <= 3000 and cache.get(req_text=absolute, **request) is None
+    # a mapped response can be discarded while it is used
+    view = cache.get(req_text='MOCK FD 12', **request)
+    cache.clear()
+    assert view == large and cache.size == 0 and not os.listdir(tmp_path)
+
+
+def test_client_cache(tmp_path):
+    async def main():
+        client = AddeClient(host='127.0.0.1', cache=ResponseCache(directory=str(tmp_path)))
+        responses = []
+
+        async def query(req_type=None, bin_req=None, timeout=None, **kwargs):
+            responses.append(bin_req)
+            return struct.pack('>2i', 8, 1)
+        client._query_server_stream_ = query
+        for _ in range(2):
+            data = await client._query_server_(req_type='adir', req_text='MOCK FD 3 3 BAND=2')
+            assert bytes(data) == struct.pack('>2i', 8, 1)
+        assert len(responses) == 1
+    asyncio.run(main())
+
+
+def text_response(lines=None):
+    """
+    txtg response, 2 ints (4, 1) followed by the size prefixed lines and a 0 size
+    """
+    chunks = [struct.pack('>2i', 4, 1)]
+    for line in lines:
+        chunks.append(struct.pack('>i', len(line) + 1) + line.encode('ascii') + b'\x00')
+    return b''.join(chunks + [struct.pack('>i', 0)])
+
+
+CATALOG = text_response([
+    'N1=MOCK,N2=FD,TYPE=IMAGE,RT=N,K=AREA,R1=1,R2=6,MASK=,C=Mock full disk,',
+    'N1=MOCK,N2=CONUS,TYPE=IMAGE,RT=N,K=AREA,R1=1,R2=6,MASK=,C=Mock CONUS,',
+    'N1=OTHER,N2=FD,TYPE=IMAGE,RT=N,K=AREA,R1=1,R2=6,MASK=,C=Other full disk,',
+])
+ERROR = bytes(12) + b'No such file'.ljust(72) + bytes(12)
+
+
+def catalog_client(registry=None, responses=None, delay=0., host='server', port=112):
+    """
+    AddeClient whose catalog requests are answered in turn from responses
+    """
+    client = AddeClient(host=host, port=port, catalog_registry=registry)
+    client.fetches = 0
+
+    async def fetch():
+        client.fetches += 1
+        await asyncio.sleep(delay)
+        return responses[min(client.fetches, len(responses)) - 1]
+    client._fetch_binary_content_ = fetch
+    return client
+
+
+def test_catalog_registry(tmp_path):
+    async def main():
+        registry = CatalogRegistry(directory=str(tmp_path))
+        # an error reply is neither cached nor persisted
+        client = catalog_client(registry, [ERROR, CATALOG])
+        with pytest.raises(Exception):
+            await registry.entry(client)
+        assert not os.listdir(tmp_path)
+        # concurrent clients of the same server share one fetch
+        clients = [catalog_client(registry, [CATALOG], delay=.01) for _ in range(3)]
+        entries = await asyncio.gather(*[registry.entry(c) for c in clients])
+        assert sum(c.fetches for c in clients) == 1 and all(e is entries[0] for e in entries)
+        assert [c['N2'] for c in entries[0].content] == ['FD', 'CONUS', 'FD']
+        async with catalog_client(registry, [ERROR]) as known:  # no round trip
+            assert known.fetches == 0 and known.content is entries[0].content
+        # the persisted catalogs are used by later processes, the ones that do not parse are fetched again
+        client = catalog_client(CatalogRegistry(directory=str(tmp_path)), [ERROR])
+        assert (await client.catalog_registry.entry(client)).binary_content == CATALOG and client.fetches == 0
+        with open(os.path.join(tmp_path, 'server_112.srv'), 'wb') as f:
+            f.write(CATALOG[:30])
+        client = catalog_client(CatalogRegistry(directory=str(tmp_path)), [CATALOG])
+        assert (await client.catalog_registry.entry(client)).binary_content == CATALOG and client.fetches == 1
+    asyncio.run(main())
+
+
+def test_catalog_registry_loops():
+    registry = CatalogRegistry()
+    started, release = threading.Event(), threading.Event()
+
+    async def blocked_fetch():
+        started.set()
+        while not release.is_set():
+            await asyncio.sleep(.01)
+        return CATALOG
+    client = catalog_client(registry, [CATALOG])
+    client._fetch_binary_content_ = blocked_fetch
+    thread = threading.Thread(target=asyncio.run, args=(registry.entry(client), ))
+    thread.start()
+    try:
+        started.wait(5)
+        # a client in another event loop does not wait for the fetch of the first loop
+        entry = asyncio.run(asyncio.wait_for(registry.entry(catalog_client(registry, [CATALOG])), 5))
+        assert entry.binary_content == CATALOG
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_server_catalog():
+    async def main():
+        registry = CatalogRegistry()
+        content = text_response([
+            'N1=MOCK,N2=FD,TYPE=IMAGE,RT=N,K=AREA,R1=1,R2=6,MASK=,C=Mock full disk,',
+            'N1=MOCK,N2=CONUS,TYPE=IMAGE,RT=N,K=AREA,R1=1,R2=6,MASK=,C=Mock CONUS,',
+            'N1=OTHER,N2=FD,TYPE=IMAGE,RT=N,K=AREA,R1=1,R2=6,MASK=,C=Other full disk,',
+            'N1=TEXT,N2=BULLETIN,TYPE=TEXT,RT=N,K=TEXT,R1=1,R2=6,MASK=,C=Bulletins,',
+        ])
+        async with catalog_client(registry, [content]) as client:
+            catalog = client.catalog
+            assert catalog.has_group('mock') and not catalog.has_group('text') and catalog.has_group('text', only_image=False)
+            assert catalog.descriptor('Mock', 'fd').comment == 'Mock full disk'
+            assert catalog.descriptor('mock', 'bulletin') is None and catalog.descriptor('none', 'fd') is None
+            assert sorted(client.group_names) == ['MOCK', 'OTHER']
+            assert sorted(client._extract_descriptors_(group_name='mock')) == [('CONUS', 'Mock CONUS'), ('FD', 'Mock full disk')]
+            client._validate_dataset_(group='mock', descriptor='conus')
+            with pytest.raises(AssertionError):
+                client._validate_dataset_(group='MOCK', descriptor='BULLETIN')
+            with pytest.raises(AssertionError):
+                client._validate_dataset_(group='TEXT', descriptor='BULLETIN')
+    asyncio.run(main())
+
+
+def mcidas_date_time(dt=None):
+    return (dt.year - 1900) * 1000 + dt.timetuple().tm_yday, dt.hour * 10000 + dt.minute * 100 + dt.second
+
+
+def directory_words(area_number=1, nominal_time=None, band=2, lines=300, elements=200, line_ul=0, element_ul=0,
+                    resolution=1, comments=1):
+    """
+    The 64 words of a synthetic AREA directory
+    """
+    words = np.zeros(64, dtype='>i4')
+    words[1] = 4
+    words[2] = 186
+    words[3:5] = mcidas_date_time(nominal_time or datetime.datetime(2020, 1, 1))
+    words[5:7] = line_ul, element_ul
+    words[8:11] = lines, elements, 2
+    words[11:13] = resolution, resolution
+    words[13:15] = 1, 0
+    words[18] = 1 << (band - 1)
+    words[32] = area_number
+    words[33] = 256 + 512  # data offset, after the directory and the navigation
+    words[34] = 256
+    words[45:47] = words[3:5]
+    words[63] = comments
+    return words
+
+
+def adir_response(directories=None):
+    """
+    adir response, every record is its size, the area number, the directory words and the comments
+    """
+    chunks = []
+    for words in directories:
+        comments = b''.join(f'comment {i} of area {words[32]}'.ljust(80).encode('ascii') for i in range(words[63]))
+        chunks.append(struct.pack('>2i', 4 + 256 + len(comments), words[32]) + words.astype('>i4').tobytes() + comments)
+    return b''.join(chunks + [bytes(8)])
+
+
+def aget_response(words=None, data=None):
+    """
+    aget response, the size of the AREA file followed by the directory, the navigation and the (lines, elements) data
+    """
+    area = words.astype('>i4').tobytes() + bytes(512) + data.astype('>i2').tobytes()
+    return struct.pack('>i', len(area)) + area
+
+
+@pytest.mark.parametrize('comments', ((1, 1, 1, 1, 1), (1, 0, 2, 1, 3)))
+def test_adir_table(comments):
+    async def main():
+        start = datetime.datetime(2020, 1, 1)
+        order = [3, 0, 4, 1, 2]
+        directories = [directory_words(area_number=10 + i, nominal_time=start + datetime.timedelta(minutes=10 * i),
+                                       band=2 + i % 2, lines=100 * (i + 1), comments=c) for i, c in zip(order, comments)]
+        response = adir_response(directories)
+        client = await catalog_client(CatalogRegistry(), [CATALOG]).__aenter__()
+
+        async def query(req_type=None, req_text=None, **kwargs):
+            return response
+        client._query_server_ = query
+        table = await client.adir_table(group='MOCK', descriptor='FD', position='ALL', band='ALL')
+        assert len(table) == 5
+        assert list(table.area_number) == [10, 11, 12, 13, 14] and list(table.lines) == [100, 200, 300, 400, 500]
+        assert list(table.band) == [2, 3, 2, 3, 2]
+        assert list(table.nominal_time) == [np.datetime64(start + datetime.timedelta(minutes=10 * i)) for i in range(5)]
+        wide = table.filter(table.lines > 250).sort('lines', reverse=True)
+        assert list(wide['area_number']) == [14, 13, 12]
+        # the rows are the area directories adir returns
+        directory = wide[0]
+        assert directory.lines == 500 and directory.group == 'MOCK' and directory.descriptor == 'FD'
+        assert directory.comments == adir_response([directories[order.index(4)]])[8 + 256:-8]
+        if set(comments) == {1}:  # the row by row parser needs the comments
+            assert [d.lines for d in client._parse_adir_response_(response)] == list(table.lines)
+        with pytest.raises(Exception):
+            AreaDirectoryTable.from_response(ERROR)
+    asyncio.run(main())
+
+
+def test_executor():
+    async def main():
+        data = np.arange(100000, dtype='>i4').tobytes()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            # the chunks are inflated in order in the executor, the reading pauses while too many are waiting
+            protocol = AddeBufferedProtocol(compressed=True, executor=executor)
+            response = await receive(protocol, gzip.compress(data), 100)
+            assert response.tobytes() == data and protocol.transport.paused > 0
+            protocol = AddeBufferedProtocol(compressed=True, executor=executor)
+            with pytest.raises(TruncatedResponseError):
+                await receive(protocol, gzip.compress(data)[:1000], 100)
+            # the parsing runs in the executor
+            client = AddeClient(host='127.0.0.1', executor=executor)
+            assert await client._run_blocking_(threading.current_thread) is not threading.current_thread()
+            assert await AddeClient(host='127.0.0.1')._run_blocking_(threading.current_thread) is threading.current_thread()
+        with pytest.raises(AssertionError):
+            AddeClient(host='127.0.0.1', executor=concurrent.futures.ProcessPoolExecutor())
+    asyncio.run(main())
+
+
+def test_single_flight():
+    async def main():
+        response = adir_response([directory_words(area_number=10, nominal_time=datetime.datetime(2020, 1, 1))])
+        registry = CatalogRegistry()
+        queries = []
+
+        async def query(req_type=None, req_text=None, **kwargs):
+            queries.append(req_text)
+            await asyncio.sleep(.05)
+            if 'BAND=4' in req_text:
+                raise Exception('No such band')
+            return response
+        clients = []
+        for coalesce in True, True, False:
+            client = await catalog_client(registry, [CATALOG]).__aenter__()
+            client.coalesce = coalesce
+            client._query_server_ = query
+            clients.append(client)
+        coalesced = INFLIGHT_REQUESTS.coalesced
+        # the identical requests of the clients share a transfer, the ones of clients not coalescing do not
+        results = await asyncio.gather(*[c.adir(group='MOCK', descriptor='FD', position=0, band=2) for c in clients * 2])
+        assert len(queries) == 3 and INFLIGHT_REQUESTS.coalesced == coalesced + 3
+        assert all(r[0].lines == 300 for r in results) and results[0] is not results[1]
+        # a cancelled caller does not cancel the shared transfer
+        queries.clear()
+        first = asyncio.ensure_future(clients[0].adir(group='MOCK', descriptor='FD', position=0, band=3))
+        second = asyncio.ensure_future(clients[1].adir(group='MOCK', descriptor='FD', position=0, band=3))
+        await asyncio.sleep(.01)
+        first.cancel()
+        assert (await second)[0].lines == 300 and len(queries) == 1
+        # the errors reach all the callers
+        results = await asyncio.gather(*[c.adir(group='MOCK', descriptor='FD', position=0, band=4) for c in clients[:2]],
+                                       return_exceptions=True)
+        assert all(str(r) == 'No such band' for r in results) and len(INFLIGHT_REQUESTS) == 0
+    asyncio.run(main())
+
+
+def test_magnify():
+    array = np.arange(24, dtype='>i2').reshape(2, 3, 4)
+    expected = np.stack([np.kron(a, np.ones((2, 3), dtype=a.dtype)) for a in array])
+    assert np.array_equal(util.magnify(array, 2, 3), expected)
+    view = util.magnify(array, 2, 3, view=True)
+    assert view.shape == (2, 3, 2, 4, 3) and np.shares_memory(view, array)
+    assert np.array_equal(view.reshape(expected.shape), expected)
+    assert np.array_equal(util.blowup(array[1], 2, 3), expected[1]) and np.array_equal(util.scale(array[1], 2, 3), expected[1])
+    with pytest.raises(AssertionError):
+        util.magnify(array, 0, 1)
+
+
+@pytest.mark.parametrize('mag_view', (False, True))
+def test_aget_blowup(mag_view):
+    async def main():
+        data = np.arange(6 * 5, dtype='>i2').reshape(6, 5)
+        words = directory_words(lines=6, elements=5, line_ul=100, element_ul=200, resolution=4)
+        client = await catalog_client(CatalogRegistry(), [CATALOG]).__aenter__()
+        requests = []
+
+        async def query(req_type=None, req_text=None, **kwargs):
+            requests.append(req_text)
+            return aget_response(words, data)
+        client._query_server_ = query
+        area = await client.aget(group='MOCK', descriptor='FD', position=0, band=2, lmag=2, emag=4, mag_view=mag_view,
+                                 day='2020001', stime='00:00:00', etime='00:00:00', nlines=6, nelems=5)
+        # the server is asked for the unmagnified image
+        assert 'LMAG=1 EMAG=1' in ' '.join(requests[0].split()).upper()
+        expected = np.kron(data, np.ones((2, 4), dtype=data.dtype))
+        assert np.array_equal(area.data.reshape((1, 12, 20)), expected[None])
+        assert area.data.shape == ((1, 6, 2, 5, 4) if mag_view else (1, 12, 20))
+        assert (area.directory.lines, area.directory.elements) == (12, 20) and (area.lmag, area.emag) == (2, 4)
+        assert (area.directory.line_res, area.directory.element_res) == area.resolution == (2., 1.)
+        lines, elements = area.image_coordinates(np.array([0, 11]), np.array([0, 19]))
+        assert list(lines) == [100, 122] and list(elements) == [200, 219]
+    asyncio.run(main())
+
+
+def test_aget_stream():
+    async def main():
+        data = np.arange(10 * 7, dtype='>i2').reshape(10, 7)
+        words = directory_words(lines=10, elements=7, resolution=2)
+        client = await catalog_client(CatalogRegistry(), [CATALOG]).__aenter__()
+        args = dict(group='MOCK', descriptor='FD', position=0, band=2, day='2020001', stime='00:00:00', etime='00:00:00',
+                    nlines=10, nelems=7)
+
+        def serve(response):
+            async def iter_server(req_type=None, req_text=None, timeout=None):
+                for i in range(0, len(response), 100):
+                    yield response[i:i + 100]
+            client._iter_server_ = iter_server
+        serve(aget_response(words, data))
+        blocks = [b async for b in client.aget_stream(block_lines=4, **args)]
+        assert [b.start_line for b in blocks] == [0, 4, 8] and blocks[0].prefix is None
+        assert np.array_equal(np.concatenate([b.data for b in blocks], axis=1), data[None])
+        # the blocks and the directory are blown up like the image aget returns
+        blocks = [b async for b in client.aget_stream(block_lines=4, lmag=2, emag=3, **args)]
+        assert [b.start_line for b in blocks] == [0, 8, 16]
+        assert np.array_equal(np.concatenate([b.data for b in blocks], axis=1)[0], np.kron(data, np.ones((2, 3), dtype=data.dtype)))
+        directory = blocks[0].directory
+        assert (directory.lines, directory.elements, directory.line_res, directory.element_res) == (20, 21, 1., 2 / 3)
+        # the lines received before the response ends are yielded
+        serve(aget_response(words, data)[:-7 * 2 * 5])
+        blocks = []
+        with pytest.raises(TruncatedResponseError, match='ended after 5 of 10 lines'):
+            async for block in client.aget_stream(block_lines=4, **args):
+                blocks.append(block)
+        assert sum(b.data.shape[1] for b in blocks) == 5
+        serve(ERROR)
+        with pytest.raises(Exception, match='No such file'):
+            async for block in client.aget_stream(**args):
+                pass
+    asyncio.run(main())
+
+
+def test_adir_stream():
+    async def main():
+        start = datetime.datetime(2020, 1, 1)
+        directories = [directory_words(area_number=10 + i, nominal_time=start - datetime.timedelta(minutes=10 * i),
+                                       comments=i) for i in range(4)]
+        client = await catalog_client(CatalogRegistry(), [CATALOG]).__aenter__()
+        args = dict(group='MOCK', descriptor='FD', position='ALL', band=2)
+
+        def serve(response):
+            async def iter_server(req_type=None, req_text=None, timeout=None):
+                for i in range(0, len(response), 50):
+                    yield response[i:i + 50]
+            client._iter_server_ = iter_server
+        serve(adir_response(directories))
+        # the directories are yielded in the order they arrive, the comments are parsed
+        adirs = [d async for d in client.adir_stream(**args)]
+        assert [d.lines for d in adirs] == [300] * 4 and [d.comment_count for d in adirs] == [0, 1, 2, 3]
+        assert all(d.group == 'MOCK' and d.descriptor == 'FD' for d in adirs)
+        # or sorted by nominal time like adir returns them
+        async def query(req_type=None, req_text=None, **kwargs):
+            return adir_response(directories)
+        client._query_server_ = query
+        adirs = [d async for d in client.adir_stream(ordered=True, **args)]
+        assert [d.comment_count for d in adirs] == [3, 2, 1, 0]
+        # a listing cut after some directories was not complete
+        serve(adir_response(directories)[:-8])
+        adirs = []
+        with pytest.raises(TruncatedResponseError, match='ended before the end of the listing'):
+            async for adir in client.adir_stream(**args):
+                adirs.append(adir)
+        assert len(adirs) == 4
+        serve(ERROR)
+        with pytest.raises(Exception, match='No such file'):
+            async for adir in client.adir_stream(**args):
+                pass
+    asyncio.run(main())
+
+
+def test_scheduler():
+    async def main():
+        scheduler = ConnectionScheduler(max_per_host=2, max_total=3, host_limits={'slow': 1})
+        order = []
+
+        async def job(name=None, host='h', priority=PRIORITY_DEFAULT, tenant=None):
+            async with scheduler.slot(host=host, priority=priority, tenant=tenant) as slot:
+                order.append(name)
+                await asyncio.sleep(.01)
+            return slot
+
+        # the per host and the global limits
+        slots = await asyncio.gather(*[job(host=h) for h in ['h'] * 3 + ['slow'] * 2 + ['other'] * 2])
+        assert scheduler.active == 0 and scheduler.stats('h')['requests'] == 3
+        assert scheduler.stats('slow')['max_wait_time'] >= .01 and all(s.transfer_time >= .01 for s in slots)
+        # the waiters are granted by priority, round robin between the tenants of a priority
+        order.clear()
+        busy = scheduler.slot(host='h')
+        await busy.__aenter__()
+        blocker = scheduler.slot(host='h')
+        await blocker.__aenter__()
+        waiters = [asyncio.ensure_future(job(name=n, priority=p, tenant=t)) for n, p, t in [
+            ('a1', PRIORITY_BACKFILL, 'a'), ('a2', PRIORITY_DEFAULT, 'a'), ('a3', PRIORITY_DEFAULT, 'a'),
+            ('b1', PRIORITY_DEFAULT, 'b'), ('r1', PRIORITY_REALTIME, 'a')
+        ]]
+        await asyncio.sleep(0)
+        assert scheduler.stats('h')['queued'] == 5
+        await busy.__aexit__(None, None, None)
+        await blocker.__aexit__(None, None, None)
+        await asyncio.gather(*waiters)
+        assert order == ['r1', 'a2', 'b1', 'a3', 'a1']
+    asyncio.run(main())
+
+
+def test_scheduler_cancelled_waiter():
+    async def main():
+        scheduler = ConnectionScheduler(max_per_host=1)
+
+        async def job():
+            async with scheduler.slot(host='h'):
+                await asyncio.sleep(0)
+
+        # cancelled while waiting in the queue
+        slot = scheduler.slot(host='h')
+        await slot.__aenter__()
+        waiter = asyncio.ensure_future(job())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await slot.__aexit__(None, None, None)
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.active == 0
+        # cancelled after the slot was granted but before the task resumed
+        slot = scheduler.slot(host='h')
+        await slot.__aenter__()
+        waiter = asyncio.ensure_future(job())
+        await asyncio.sleep(0)
+        await slot.__aexit__(None, None, None)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.active == 0
+        await asyncio.wait_for(job(), 1)
+    asyncio.run(main())
+
+
+def test_scheduler_loops():
+    scheduler = ConnectionScheduler(max_per_host=1)
+
+    async def hold():
+        # the slot held when the loop ends does not block the next loops
+        await scheduler.slot(host='h').__aenter__()
+
+    asyncio.run(hold())
+
+    async def job():
+        async with scheduler.slot(host='h'):
+            pass
+    asyncio.run(asyncio.wait_for(job(), 1))
+
+
+def test_adaptive_concurrency(monkeypatch):
+    clock = [0.]
+    monkeypatch.setattr('pyadde.scheduler.time', types.SimpleNamespace(perf_counter=lambda: clock[0]))
+    adaptive = AdaptiveConcurrency(initial_window=2, max_window=4, interval=1.)
+
+    def interval(nbytes=None, saturated=True):
+        adaptive.window('h')  # the first interval of a host starts when it is first seen
+        clock[0] += 1
+        adaptive.observe(host='H', nbytes=nbytes, saturated=saturated)
+
+    # additive increase while the saturated intervals improve the throughput, up to max_window
+    for nbytes, window in (100, 3), (200, 4), (400, 4):
+        interval(nbytes)
+        assert adaptive.window('h') == window
+    assert adaptive.throughput('h') == 400.
+    # no increase without a throughput gain or when the connections were not all in use
+    adaptive = AdaptiveConcurrency(initial_window=2, max_window=8, interval=1.)
+    interval(100)
+    interval(101)
+    interval(1000, saturated=False)
+    assert adaptive.window('h') == 3
+    # multiplicative decrease on congestion errors, once per interval
+    adaptive.observe(host='h', error=ConnectionResetError())
+    adaptive.observe(host='h', error=asyncio.TimeoutError())
+    assert adaptive.window('h') == 1 and adaptive.stats()['h']['errors'] == 2
+    adaptive.observe(host='h', error=ValueError())
+    assert adaptive.stats()['h']['errors'] == 2
+    # and when the throughput collapses
+    adaptive = AdaptiveConcurrency(initial_window=4, interval=1.)
+    interval(1000)
+    interval(100)
+    assert adaptive.window('h') == 2
+
+
+def test_adaptive_scheduler():
+    async def main():
+        async def handle(reader, writer):
+            await reader.read(160)
+            writer.write(bytes(1000))
+            await writer.drain()
+            writer.close()
+        server = await asyncio.start_server(handle, host='127.0.0.1', port=0)
+        port = server.sockets[0].getsockname()[1]
+        adaptive = AdaptiveConcurrency(initial_window=4)
+        client = AddeClient(host='127.0.0.1', port=port, scheduler=ConnectionScheduler(adaptive=adaptive))
+        assert client.scheduler.host_limit('127.0.0.1') == 4
+        # an exception handled by the consumer of a stream is not an error of the stream
+        try:
+            raise ConnectionResetError()
+        except ConnectionResetError:
+            chunks = [c async for c in client._iter_server_(req_type='adir', req_text='MOCK FD 0')]
+        assert sum(map(len, chunks)) == 1000 and adaptive.window('127.0.0.1') == 4
+        # the errors of the connections shrink the window
+        server.close()
+        await server.wait_closed()
+        with pytest.raises(ConnectionRefusedError):
+            async for _ in client._iter_server_(req_type='adir', req_text='MOCK FD 0'):
+                pass
+        assert adaptive.window('127.0.0.1') == 2 and client.scheduler.host_limit('127.0.0.1') == 2
+    asyncio.run(main())
+
+
+def failover_client(behaviours=None, calls=None, **kwargs):
+    """
+    AddeClient whose connections to a host run behaviours[host](), the hosts are recorded in calls
+    """
+    client = AddeClient(host='127.0.0.2', latencies=LatencyTracker(), retry_backoff=0, **kwargs)
+
+    async def query(req_type=None, bin_req=None, timeout=None, host=None):
+        calls.append(host)
+        return await behaviours[host]()
+    client._query_server_stream_ = query
+    return client
+
+
+def test_failover(tmp_path):
+    async def main():
+        async def reset():
+            raise ConnectionResetError()
+
+        async def full():
+            raise OSError(28, 'No space left on device')
+
+        async def answer():
+            return b'response'
+        calls = []
+        cache = ResponseCache(directory=str(tmp_path))
+        client = failover_client({'127.0.0.2': reset, '127.0.0.3': answer}, calls, mirrors=['127.0.0.3'], retries=1,
+                                 cache=cache)
+        # the retry goes to the mirror, the failed host is ranked last afterwards
+        assert await client._query_server_(req_type='adir', req_text='MOCK FD 0') == b'response'
+        assert calls == ['127.0.0.2', '127.0.0.3']
+        assert client.latencies.rank(hosts=('127.0.0.2', '127.0.0.3'), req_type='adir') == ['127.0.0.3', '127.0.0.2']
+        # the response is cached for the host that sent it and served to the requests made to any mirror
+        assert cache.get(host='127.0.0.3', port=112, req_type='adir', req_text='MOCK FD 0') == b'response'
+        assert cache.get(host='127.0.0.2', port=112, req_type='adir', req_text='MOCK FD 0') is None
+        assert await client._query_server_(req_type='adir', req_text='MOCK FD 0') == b'response' and len(calls) == 2
+        # the local errors are not retried
+        calls.clear()
+        client = failover_client({'127.0.0.2': full, '127.0.0.3': answer}, calls, mirrors=['127.0.0.3'], retries=3)
+        with pytest.raises(OSError):
+            await client._query_server_(req_type='adir', req_text='MOCK FD 0')
+        assert calls == ['127.0.0.2']
+        # the retries run out
+        calls.clear()
+        client = failover_client({'127.0.0.2': reset}, calls, retries=2)
+        with pytest.raises(ConnectionResetError):
+            await client._query_server_(req_type='adir', req_text='MOCK FD 0')
+        assert len(calls) == 3
+    asyncio.run(main())
+
+
+def test_hedging():
+    async def main():
+        closed = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(5)
+            finally:
+                closed.append(True)
+
+        async def fast():
+            await asyncio.sleep(.01)
+            return b'response'
+        calls = []
+        client = failover_client({'127.0.0.2': slow, '127.0.0.3': fast}, calls, mirrors=['127.0.0.3'],
+                                 hedge_percentile=90)
+        for _ in range(10):
+            client.latencies.record(host='127.0.0.2', req_type='aget', latency=.05)
+        # the request slower than the 90th percentile of its host is sent to the mirror, the first response wins
+        assert await client._query_server_(req_type='aget', req_text='MOCK FD 0') == b'response'
+        assert calls == ['127.0.0.2', '127.0.0.3']
+        # and the other request is over when it returns
+        assert closed == [True] and client.scheduler.stats('127.0.0.2')['active'] == 0
+        # without enough latencies to compare with the request is not hedged
+        calls.clear()
+        client = failover_client({'127.0.0.2': fast, '127.0.0.3': fast}, calls, mirrors=['127.0.0.3'],
+                                 hedge_percentile=90)
+        assert await client._query_server_(req_type='aget', req_text='MOCK FD 0') == b'response'
+        assert calls == ['127.0.0.2']
+    asyncio.run(main())
@@ -96,18 +96,38 @@ def timeit(func=None,loops=1,verbose=False, clear_cache=False, sudo_passwd=None)
 
 
 
+def magnify(input_array=None, dim1_fact=1, dim2_fact=1, view=False):
+    """
+    Blow up (replicate) the last two dimensions of an array by integer factors.
+    The replication is expressed as a broadcast so no temporary arrays are created.
+    :param input_array: numpy array with at least 2 dimensions, (..., lines, elements)
+    :param dim1_fact: int, line magnification factor (>=1)
+    :param dim2_fact: int, element magnification factor (>=1)
+    :param view: bool, if True return a zero copy read only view of shape (..., lines, dim1_fact, elements, dim2_fact)
+            otherwise an array of shape (..., lines*dim1_fact, elements*dim2_fact) is materialized in one pass
+    :return: numpy array
+    """
+    assert input_array.ndim >= 2, f'input_array has to be at least 2 dimensional'
+    dim1_fact = int(dim1_fact)
+    dim2_fact = int(dim2_fact)
+    assert dim1_fact >= 1 and dim2_fact >= 1, f'Invalid magnification factors {dim1_fact} {dim2_fact}'
+    n, m = input_array.shape[-2:]
+    lead = input_array.shape[:-2]
+    shape = lead + (n, dim1_fact, m, dim2_fact)
+    blown = np.broadcast_to(input_array[..., :, None, :, None], shape)
+    if view:
+        return blown
+    out = np.empty(lead + (n * dim1_fact, m * dim2_fact), dtype=input_array.dtype)
+    out.reshape(shape)[...] = blown
+    return out
+
+
 @timeit
 def blowup(input_array=None,dim1_fact=None, dim2_fact=None):
     assert input_array.ndim == 2, f'input_array has to be 2 dimensional'
-    return np.kron(input_array, np.ones((dim1_fact, dim2_fact))).view(input_array.dtype)
+    return magnify(input_array=input_array, dim1_fact=dim1_fact, dim2_fact=dim2_fact)
+
 
 @timeit
 def scale(input_array, scale_dim1, scale_dim2):     # fill A with B scaled by k
-    n, m = input_array.shape
-    Y = n * scale_dim1
-    X = m * scale_dim2
-    A = np.empty(shape=(Y, X), dtype=input_array.dtype)
-    for y in range(0, scale_dim1):
-        for x in range(0, 2):
-            A[y:Y:scale_dim1, x:X:scale_dim2] = input_array
-    return A
\ No newline at end of file
+    return magnify(input_array=input_array, dim1_fact=scale_dim1, dim2_fact=scale_dim2)
@@ -25,6 +25,8 @@ setup(
     license='LGPL',
     long_description=open('./README').read(),
     data_files=[('lic', ['./LICENSE'])],
+    # asyncio.BufferedProtocol, memoryview.toreadonly
+    python_requires='>=3.8',
     #install_requires= [    ]
 
 